@@ -0,0 +1,62 @@
+#!/usr/bin/env python2.7
+# Events/s through EventDispatch against the Queue.PriorityQueue dispatcher it replaced.
+# Run from the repository root: PYTHONPATH=. bin/bench-dispatch.py [events]
+import Queue
+import sys
+import time
+
+from collections import defaultdict, namedtuple
+
+from freecell.shared.dispatch import EventDispatch
+
+BenchEvent = namedtuple('BenchEvent', ['value'])
+
+class PriorityQueueDispatch(object):
+    def __init__(self):
+        self.queue = Queue.PriorityQueue()
+        self.registered = defaultdict(list)
+
+    def register(self, callback, event_types):
+        for event_type in event_types:
+            self.registered[event_type].append(callback)
+
+    def send(self, event, priority=5):
+        self.queue.put((priority, time.time(), event))
+
+    def update(self, max_time):
+        start = time.time()
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            event = item[2]
+            for callback in self.registered[type(event).__name__]:
+                callback(event)
+            self.queue.task_done()
+
+            if time.time() - start >= max_time:
+                return False
+        else:
+            return True
+
+def bench(dispatch, count):
+    received = []
+    dispatch.register(received.append, ["BenchEvent"])
+    event = BenchEvent(value=1)
+
+    start = time.time()
+    for i in xrange(count):
+        dispatch.send(event, priority=(5, 5, 5, 2)[i & 3])
+    sent = time.time()
+    dispatch.update(3600)
+    done = time.time()
+
+    assert len(received) == count
+    return count / (sent - start), count / (done - sent), count / (done - start)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print "%d events, events/s:     send      dispatch     total" % count
+    results = {}
+    for name, cls in (("PriorityQueue", PriorityQueueDispatch), ("EventDispatch", EventDispatch)):
+        results[name] = bench(cls(), count)
+        print "%-20s %12.0f %12.0f %12.0f" % ((name,) + results[name])
+    print "speedup: %.1fx" % (results["EventDispatch"][2] / results["PriorityQueue"][2])
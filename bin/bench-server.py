@@ -0,0 +1,362 @@
+#!/usr/bin/env python2.7
+# Simulated competitors against a CompetitionServer over loopback, through FreeCellNetworking.
+# Each client connects, registers, logs in, joins a room, asks for a seed, plays for a random
+# time and sends its stats. Reports connection rate, round trips, fan-out and server CPU.
+# Run from the repository root: PYTHONPATH=. bin/bench-server.py [clients=N] [room_size=N]
+#     [rate=CONNECTS_PER_S] [play=MIN,MAX] [games=N] [resume] [port=P pid=SERVER_PID] [timeout=S]
+# Without pid a server is started on port with a scratch user database.
+import asyncore
+import hashlib
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from freecell.client.events import *
+from freecell.client.network import FreeCellNetworking, SENT_EVENTS
+from freecell.server.timerwheel import TimerWheel
+from freecell.shared.dispatch import EventDispatch
+from freecell.shared.instrument import Histogram
+
+SERVER = "import sys; from freecell.server.competitionserver import CompetitionServer; " \
+         "CompetitionServer('localhost', int(sys.argv[1]), max_connections=int(sys.argv[2])).start()"
+
+class SimulatedClient(FreeCellNetworking):
+    """
+    A competitor driven by its own EventDispatch, updated as soon as a
+    message arrives, so many of them share one asyncore loop.
+    """
+    def __init__(self, bench, index, ticket=None):
+        """
+        :param LoadTest bench: Load test
+        :param int index: Client number, also sent as the undo count to tell stats apart
+        :param str ticket: Log in with this ticket instead of registering
+        """
+        self.bench = bench
+        self.index = index
+        self.username = "bench%d_%d" % (bench.port, index)
+        self.room = "bench%d" % (index // bench.room_size)
+        self.ticket = ticket
+        self.games = 0
+        self.id = None
+        """:type : str | None (learned from the echo of its own stats)"""
+        self.sent = {}
+        """:type : dict[str, float] (message name to send time)"""
+        self.started = time.time()
+        FreeCellNetworking.__init__(self, "localhost", bench.port, event_dispatch=EventDispatch())
+
+        self.event_dispatch.register(self.send_event, SENT_EVENTS.keys())
+        self.event_dispatch.register(self.challenge, ["ChallengeEvent"])
+        self.event_dispatch.register(self.registered, ["LoginTokenEvent"])
+        self.event_dispatch.register(self.nonce, ["NonceEvent"])
+        self.event_dispatch.register(self.save_ticket, ["TicketEvent"])
+        self.event_dispatch.register(self.logged_in, ["LoggedInEvent"])
+        self.event_dispatch.register(self.joined, ["RoomEvent"])
+        self.event_dispatch.register(self.seeded, ["SeedEvent"])
+        self.event_dispatch.register(self.failed, ["QuitEvent", "LoginFailedEvent", "NameTakenEvent", "UnknownUserEvent"])
+
+    def send_message(self, name, **values):
+        self.sent[name] = time.time()
+        FreeCellNetworking.send_message(self, name, **values)
+
+    def round_trip(self, name, sent=None):
+        """
+        :param str name: Message sent
+        :param str sent: Name to record it under, name by default
+        """
+        self.bench.record(sent or name, time.time() - self.sent[name])
+
+    def handle_connect(self):
+        self.bench.connected += 1
+        FreeCellNetworking.handle_connect(self)
+        self.event_dispatch.update(1.0)
+
+    def handle_error(self):
+        FreeCellNetworking.handle_error(self)
+        self.event_dispatch.update(1.0)
+
+    def handle_close(self):
+        if self.bench.clients.get(self.index) is self:
+            self.failed(QuitEvent(message="Server closed the connection"))
+        self.close()
+
+    def handle_message(self, message, values):
+        if message.name == "stats":
+            self.bench.delivered(self, values)
+        elif message.name == "verified" and values["id"] == self.id:
+            self.round_trip("stats", "verified")
+            self.finish_game()
+        FreeCellNetworking.handle_message(self, message, values)
+        self.event_dispatch.update(1.0)
+
+    def challenge(self, event):
+        self.round_trip("connect")
+        if self.ticket is not None:
+            self.event_dispatch.send(AuthRequestEvent(username=self.username, nonce_hash="", ticket=self.ticket))
+        else:
+            self.event_dispatch.send(RegisterEvent(username=self.username))
+
+    def registered(self, event):
+        self.round_trip("register")
+        self.token = event.token
+        self.event_dispatch.send(LoginEvent(username=self.username))
+
+    def nonce(self, event):
+        self.round_trip("login")
+        nonce_hash = hashlib.sha256(hashlib.sha256(self.token+event.salt).hexdigest()+str(event.nonce)).hexdigest()
+        self.event_dispatch.send(TokenHashEvent(username=self.username, nonce_hash=nonce_hash))
+
+    def save_ticket(self, event):
+        self.ticket = event.ticket
+
+    def logged_in(self, event):
+        self.round_trip("auth" if "auth" in self.sent else "tokenhash")
+        self.bench.record("connect to login", time.time() - self.started)
+        if self.bench.resuming:
+            self.bench.finished(self)
+        else:
+            self.event_dispatch.send(JoinRoomEvent(room=self.room))
+
+    def joined(self, event):
+        # The default room is joined on login, wait for ours
+        if event.room == self.room:
+            self.round_trip("joinroom")
+            self.event_dispatch.send(SeedRequestEvent())
+
+    def seeded(self, event):
+        self.round_trip("seedrequest")
+        self.bench.timers.schedule(random.uniform(*self.bench.play), self.play, event.seed)
+
+    def play(self, seed):
+        if self.bench.clients.get(self.index) is not self:
+            return
+        self.bench.stats_sent[(self.index, self.games)] = time.time()
+        self.event_dispatch.send(Stats(seed=seed, time=random.uniform(*self.bench.play), moves=self.games,
+                                       undos=self.index, won=False, log=[]))
+        self.event_dispatch.update(1.0)
+
+    def finish_game(self):
+        self.games += 1
+        if self.games < self.bench.games:
+            self.event_dispatch.send(SeedRequestEvent())
+        else:
+            self.bench.finished(self)
+
+    def failed(self, event):
+        self.bench.failed(self, getattr(event, "message", type(event).__name__))
+
+class LoadTest(object):
+    def __init__(self, clients, room_size, rate, play, games, port, timeout):
+        """
+        :param int clients: Simulated clients
+        :param int room_size: Clients per room, broadcasts go to the whole room
+        :param float rate: New connections per second
+        :param (float, float) play: Shortest and longest play time, seconds
+        :param int games: Games per client
+        :param int port: Server port
+        :param float timeout: Seconds before giving up on the stragglers
+        """
+        self.count = clients
+        self.room_size = room_size
+        self.rate = rate
+        self.play = play
+        self.games = games
+        self.port = port
+        self.timeout = timeout
+        self.timers = TimerWheel(tick=0.01, slots=1024)
+        self.clients = {}
+        """:type : dict[int, SimulatedClient] (still running)"""
+        self.tickets = {}
+        """:type : dict[int, str] (of the clients that finished)"""
+        self.round_trips = {}
+        """:type : dict[str, Histogram] (microseconds)"""
+        self.fan_out = Histogram()
+        """:type : Histogram (microseconds from sending stats to another room member getting them)"""
+        self.stats_sent = {}
+        """:type : dict[(int, int), float] (send time by client and game)"""
+        self.errors = {}
+        self.connected = 0
+        self.started = 0
+        self.resuming = False
+
+    def record(self, name, seconds):
+        histogram = self.round_trips.get(name)
+        if histogram is None:
+            histogram = self.round_trips[name] = Histogram()
+        histogram.add(seconds * 1e6)
+
+    def delivered(self, client, values):
+        sent = self.stats_sent.get((values["undos"], values["moves"]))
+        if sent is None:
+            return
+        if values["undos"] == client.index:
+            client.id = values["id"]
+            client.round_trip("stats")
+        else:
+            self.fan_out.add((time.time() - sent) * 1e6)
+
+    def finished(self, client):
+        if self.clients.pop(client.index, None) is client:
+            self.tickets[client.index] = client.ticket
+            client.close()
+
+    def failed(self, client, reason):
+        if self.clients.pop(client.index, None) is client:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+            client.close()
+
+    def run(self, resume=False):
+        """
+        Connect every client at the set rate and serve them until they finish.
+        :param bool resume: Reconnect the finished clients with their tickets instead
+        :return: Seconds to connect them all, seconds in all
+        :rtype: (float, float)
+        """
+        self.resuming = resume
+        indexes = sorted(self.tickets) if resume else range(self.count)
+        tickets = self.tickets
+        self.tickets = {}
+        self.connected = 0
+        self.started = len(indexes)
+        start = time.time()
+        connect_time = None
+        pending = 0
+        while (pending < len(indexes) or self.clients) and time.time() - start < self.timeout:
+            now = time.time()
+            # Connections due by now at the set rate
+            due = min(len(indexes), int((now - start) * self.rate) + 1)
+            while pending < due:
+                index = indexes[pending]
+                self.clients[index] = SimulatedClient(self, index, tickets.get(index) if resume else None)
+                pending += 1
+            if connect_time is None and self.connected >= len(indexes):
+                connect_time = now - start
+            next_timer = self.timers.next_timeout(now)
+            timeout = min(0.01, next_timer if next_timer is not None else 0.01)
+            if asyncore.socket_map:
+                asyncore.loop(timeout=timeout, count=1, use_poll=True)
+            else:
+                # poll returns at once without sockets
+                time.sleep(timeout)
+            self.timers.advance(time.time())
+
+        for client in self.clients.values():
+            self.failed(client, "Timed out")
+        return connect_time if connect_time is not None else time.time() - start, time.time() - start
+
+def process_cpu(pid):
+    """
+    :param int pid: Process
+    :return: User and system CPU seconds of the process and its children
+    :rtype: float
+    """
+    ticks = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as stat_file:
+                # Fields after the command name, which may contain spaces
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except IOError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            ticks += int(fields[11]) + int(fields[12])
+    return float(ticks) / os.sysconf("SC_CLK_TCK")
+
+def peak_memory(pid):
+    """
+    :param int pid: Process
+    :return: VmHWM line of /proc/pid/status
+    :rtype: str
+    """
+    with open("/proc/%d/status" % pid) as status_file:
+        for line in status_file:
+            if line.startswith("VmHWM:"):
+                return line.split(":", 1)[1].strip()
+    return "?"
+
+def start_server(port, clients, home):
+    """
+    :return: Server process, once it accepts connections
+    :rtype: subprocess.Popen
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, HOME=home, PYTHONPATH=root)
+    with open(os.devnull, "w") as devnull:
+        server = subprocess.Popen([sys.executable, "-c", SERVER, str(port), str(clients + 16)],
+                                  env=env, stdout=devnull, stderr=devnull)
+    for attempt in range(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+    server.kill()
+    raise SystemExit("Server did not start on port %d" % port)
+
+def report(bench, title, connect_time, elapsed, server_cpu, client_cpu):
+    print "%s: %d clients, %d finished, %.1fs" % (title, bench.started, len(bench.tickets), elapsed)
+    print "connected %d in %.2fs, %.0f connections/s" % (bench.connected, connect_time, bench.connected / max(connect_time, 1e-6))
+    for reason, count in sorted(bench.errors.items()):
+        print "  failed: %d %s" % (count, reason)
+    print "%-20s %8s %24s" % ("round trip", "count", "us p50/p99/max")
+    for name, histogram in sorted(bench.round_trips.items()):
+        print "%-20s %8d %24s" % (name, histogram.count, histogram.summary())
+    if bench.fan_out.count:
+        print "%-20s %8d %24s" % ("stats fan-out", bench.fan_out.count, bench.fan_out.summary())
+    print "server CPU %.2fs (%.0f%% of one core), load generator CPU %.2fs" % (server_cpu, 100 * server_cpu / elapsed, client_cpu)
+
+if __name__ == "__main__":
+    options = {"clients": "100", "room_size": "50", "rate": "500", "play": "1,5", "games": "1",
+               "port": "11990", "pid": None, "timeout": "120"}
+    resume = "resume" in sys.argv[1:]
+    for arg in sys.argv[1:]:
+        key, _, value = arg.partition("=")
+        if key in options and value:
+            options[key] = value
+    clients = int(options["clients"])
+    port = int(options["port"])
+
+    # A socket per client here, and another in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if clients + 64 > hard:
+        print "Warning: %d clients need more than the %d file descriptors allowed" % (clients, hard)
+
+    home = server = None
+    if options["pid"] is None:
+        home = tempfile.mkdtemp(prefix="bench-server")
+        server = start_server(port, clients, home)
+        pid = server.pid
+    else:
+        pid = int(options["pid"])
+
+    try:
+        bench = LoadTest(clients, int(options["room_size"]), float(options["rate"]),
+                         tuple(float(x) for x in options["play"].split(",")), int(options["games"]),
+                         port, float(options["timeout"]))
+        phases = [("games", False)] + ([("resume", True)] if resume else [])
+        for title, resuming in phases:
+            bench.round_trips = {}
+            bench.fan_out = Histogram()
+            bench.errors = {}
+            server_cpu = process_cpu(pid)
+            client_cpu = sum(resource.getrusage(resource.RUSAGE_SELF)[:2])
+            connect_time, elapsed = bench.run(resuming)
+            report(bench, title, connect_time, elapsed, process_cpu(pid) - server_cpu,
+                   sum(resource.getrusage(resource.RUSAGE_SELF)[:2]) - client_cpu)
+            print
+        print "server peak memory %s" % peak_memory(pid)
+    finally:
+        if server is not None:
+            # Interrupted, the server shuts its verification pool down
+            server.send_signal(signal.SIGINT)
+            server.wait()
+            shutil.rmtree(home, ignore_errors=True)
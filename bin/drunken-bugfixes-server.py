@@ -3,15 +3,42 @@ import sys
 HOST, PORT = "localhost", 11982
 
 from freecell.server.competitionserver import CompetitionServer
+from freecell.server.events import event_dispatch
+from freecell.server.network import FreecellServer
+from freecell.shared.instrument import dump_on_signal
 
 if __name__ == "__main__":
-    debug = False
+    debug = stats = False
     if len(sys.argv) > 1:
         if "debug" in sys.argv:
             sys.argv.remove("debug")
             debug = True
-        from pydevd import pydevd
-        from debug import DEBUG_HOST, DEBUG_PORT
-        pydevd.settrace(DEBUG_HOST, port=DEBUG_PORT, suspend=False)
-    competition_server = CompetitionServer(HOST, PORT)
+            from pydevd import pydevd
+            from debug import DEBUG_HOST, DEBUG_PORT
+            pydevd.settrace(DEBUG_HOST, port=DEBUG_PORT, suspend=False)
+
+    # Dispatch timings, printed at shutdown and written to stderr on SIGUSR1
+    if "stats" in sys.argv:
+        sys.argv.remove("stats")
+        stats = True
+        dump_on_signal(event_dispatch.enable_stats())
+
+    # max_connections=N caps the clients served at once
+    max_connections = FreecellServer.MAX_CONNECTIONS
+    for arg in sys.argv[1:]:
+        if arg.startswith("max_connections="):
+            sys.argv.remove(arg)
+            max_connections = int(arg[len("max_connections="):])
+
+    # metrics=PORT serves metrics in plain text on localhost:PORT, try curl localhost:PORT
+    metrics_port = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("metrics="):
+            sys.argv.remove(arg)
+            metrics_port = int(arg[len("metrics="):])
+
+    competition_server = CompetitionServer(HOST, PORT, max_connections=max_connections, metrics_port=metrics_port)
     competition_server.start()
+
+    if stats:
+        print event_dispatch.stats.report()
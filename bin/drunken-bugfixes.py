@@ -4,27 +4,42 @@
 import curses
 import sys
 
+from freecell.client.events import event_dispatch
 from freecell.client.game import FreeCellGame
+from freecell.shared.instrument import dump_on_signal
 
 if __name__ == "__main__":
 
-    debug = networking = False
+    debug = networking = stats = False
     if len(sys.argv) > 1:
         if "debug" in sys.argv:
             sys.argv.remove("debug")
             debug = True
 
+    # Dispatch timings, printed at exit and written to stderr on SIGUSR1
+    if "stats" in sys.argv:
+        sys.argv.remove("stats")
+        stats = True
+        dump_on_signal(event_dispatch.enable_stats())
+
     if len(sys.argv) > 1:
         if "network" in sys.argv:
             networking = True
             sys.argv.remove("network")
 
+    # room=NAME plays in that room instead of the server's default one
+    room = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("room="):
+            sys.argv.remove(arg)
+            room = arg[len("room="):]
+
     seed = None
     if not networking:
         if len(sys.argv) > 1:
             seed = int(sys.argv[1])
 
-    game = FreeCellGame(seed, debug, networking)
+    game = FreeCellGame(seed, debug, networking, room)
     curses.wrapper(game.start)
 
     if game.quit_message is not None:
@@ -34,4 +49,7 @@ if __name__ == "__main__":
         m, s = divmod(game.stats.time, 60)
         h, m = divmod(m, 60)
         time_str = "%dh%02dm%.2fs" % (h, m, s)
-        print "Seed %d, %s, %d moves, %d undos" % (game.stats.seed, time_str, game.stats.moves, game.stats.undos)
\ No newline at end of file
+        print "Seed %d, %s, %d moves, %d undos" % (game.stats.seed, time_str, game.stats.moves, game.stats.undos)
+
+    if stats:
+        print event_dispatch.stats.report()
\ No newline at end of file
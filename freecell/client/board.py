@@ -1,4 +1,4 @@
-import copy
+import random
 
 from collections import namedtuple
 
@@ -7,17 +7,47 @@ State = namedtuple('State', ['foundations', 'cells', 'columns'])
 ace_is_A = False
 suites = {"c":"c", "d":"d", "h":"h", "s":"s"}
 
+# Compact card codes: code = (value - 1) * 4 + suite index, which is the same
+# numbering Deck.shuffle uses for its deck_nums. All per-card properties are
+# table lookups on the code.
+SUITES = "cdhs"
+SUITE_INDEX = {"c": 0, "d": 1, "h": 2, "s": 3}
+NUM_CARDS = 52
+NO_CARD = 0xFF
+
+CARD_VALUE = bytearray(code // 4 + 1 for code in range(NUM_CARDS))
+CARD_SUITE = bytearray(code % 4 for code in range(NUM_CARDS))
+CARD_RED = bytearray(SUITES[code % 4] in "dh" for code in range(NUM_CARDS))
+
+# CAN_STACK[lower * NUM_CARDS + upper] is 1 when upper can be placed on lower
+CAN_STACK = bytearray(NUM_CARDS * NUM_CARDS)
+for _lower in range(NUM_CARDS):
+    for _upper in range(NUM_CARDS):
+        if CARD_RED[_lower] != CARD_RED[_upper] and CARD_VALUE[_lower] == CARD_VALUE[_upper] + 1:
+            CAN_STACK[_lower * NUM_CARDS + _upper] = 1
+del _lower, _upper
+
+def card_code(value, suite):
+    """
+    :param int value: Value (1-13)
+    :param str suite: Suite
+    :rtype: int
+    """
+    return (value - 1) * 4 + SUITE_INDEX[suite]
+
 class Card(object):
-    def __init__(self, value, suite):
+    """
+    Interned flyweight view of a card code. Card(value, suite) always returns
+    the same instance for the same card, so identity comparison is valid.
+    """
+    __slots__ = ('code', 'value', 'suite', 'color', 'representation')
+
+    def __new__(cls, value, suite):
         """
         :param int value: Value
         :param str suite: Suite
         """
-        self.value = value
-        self.suite = suite
-        self.color = ["b", "r"][suite in ["d", "h"]]
-        self.representation = None
-        """:type: str | None"""
+        return CARDS[card_code(value, suite)]
 
     # Can stack card onto self?
     def can_stack(self, card):
@@ -25,7 +55,7 @@ class Card(object):
         :param Card card:
         :rtype: bool
         """
-        return (self.color != card.color) and (self.value == card.value + 1)
+        return CAN_STACK[self.code * NUM_CARDS + card.code] == 1
 
     def __str__(self):
         if self.representation is None:
@@ -35,13 +65,33 @@ class Card(object):
                 self.representation = "%2d%s" % (self.value, self.suite)
         return self.representation
 
+    def __reduce__(self):
+        return Card, (self.value, self.suite)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+def _make_card(code):
+    card = object.__new__(Card)
+    card.code = code
+    card.value = CARD_VALUE[code]
+    card.suite = SUITES[CARD_SUITE[code]]
+    card.color = ["b", "r"][CARD_RED[code]]
+    card.representation = None
+    return card
+
+CARDS = tuple(_make_card(code) for code in range(NUM_CARDS))
+""":type: tuple[Card]"""
+
 class Deck(object):
     def __init__(self):
         self.cards = []
         """:type: list[Card]"""
 
     def shuffle(self, seed):
-        suites = ["c", "d", "h", "s"]
         deck_nums = range(52)
 
         for card in range(52):
@@ -49,10 +99,8 @@ class Deck(object):
             seed = (seed * 214013 + 2531011) & 0xffffffff
             c = ((seed >> 16) & 0x7fff) % cardsleft
 
-            value = deck_nums[c]/4+1 # Map val into 1-13 range
-            suite = suites[deck_nums[c] % 4] # Map suite into Clubs, Diamonds, Hearts, Spades
-
-            self.cards.append(Card(value, suite))
+            # deck_nums maps straight onto card codes: value 1-13, suite Clubs, Diamonds, Hearts, Spades
+            self.cards.append(CARDS[deck_nums[c]])
 
             # The following is clever...
             # Replace current card with the last card (which is no longer accessible)
@@ -65,52 +113,367 @@ class Deck(object):
     def deal(self):
         return self.cards.pop()
 
+# Packed tableau layout, one byte per slot:
+#   [0, 4)    free cells, card code or NO_CARD
+#   [4, 8)    foundation heights per suite index (0-13)
+#   [8, 16)   column heights
+#   [16, 168) columns, COLUMN_SIZE slots each, bottom card first
+# A column can never hold more than the 7 dealt cards plus 12 cards stacked on a king.
+NUM_CELLS = 4
+NUM_COLUMNS = 8
+COLUMN_SIZE = 19
+CELLS_OFFSET = 0
+FOUNDATIONS_OFFSET = CELLS_OFFSET + NUM_CELLS
+HEIGHTS_OFFSET = FOUNDATIONS_OFFSET + 4
+COLUMNS_OFFSET = HEIGHTS_OFFSET + NUM_COLUMNS
+TABLEAU_SIZE = COLUMNS_OFFSET + NUM_COLUMNS * COLUMN_SIZE
+
+# Zobrist keys, from a fixed seed so hashes agree between processes and runs
+def _zobrist_keys(key_source, count):
+    """
+    :param random.Random key_source: Source, drawn from in order
+    :param int count: Number of keys
+    :rtype: tuple[int]
+    """
+    return tuple(key_source.getrandbits(64) for i in range(count))
+
+_key_source = random.Random(0xF4EEC311)
+# COLUMN_KEYS[(colno * COLUMN_SIZE + depth) * NUM_CARDS + code]
+COLUMN_KEYS = _zobrist_keys(_key_source, NUM_COLUMNS * COLUMN_SIZE * NUM_CARDS)
+# CELL_KEYS[cellno * NUM_CARDS + code]
+CELL_KEYS = _zobrist_keys(_key_source, NUM_CELLS * NUM_CARDS)
+# FOUNDATION_KEYS[suite index * 14 + height]
+FOUNDATION_KEYS = _zobrist_keys(_key_source, 4 * 14)
+# Canonical variant: keys that do not depend on the column or the cell slot
+DEPTH_KEYS = _zobrist_keys(_key_source, COLUMN_SIZE * NUM_CARDS)
+FREE_CELL_KEYS = _zobrist_keys(_key_source, NUM_CARDS)
+del _key_source
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+def _mix_column(column_hash):
+    # Non-linear, so XORing columns together keeps which cards share a column
+    column_hash = (column_hash * 0x9E3779B97F4A7C15) & MASK64
+    return column_hash ^ (column_hash >> 32)
+
+def max_sequence(free_cells, free_columns):
+    """
+    Longest sequence that can be moved with the given free space.
+    :param int free_cells: Empty free cells
+    :param int free_columns: Empty columns, not counting the destination
+    :rtype: int
+    """
+    return (free_cells + 1) << free_columns
+
+# suite index -> (other colour, other colour, same colour)
+OPPOSITE = tuple(tuple([other for other in range(4) if CARD_RED[other] != CARD_RED[suite]] +
+                       [same for same in range(4) if CARD_RED[same] == CARD_RED[suite] and same != suite])
+                 for suite in range(4))
+
+def can_autoplay(packed, code):
+    """
+    Whether a card can safely go to its foundation: nothing left on the
+    table could still need to be stacked on it.
+    :param bytearray packed: Packed table
+    :param int code: Card code
+    :rtype: bool
+    """
+    value = CARD_VALUE[code]
+    suite = CARD_SUITE[code]
+    if packed[FOUNDATIONS_OFFSET + suite] != value - 1:
+        return False
+    if value <= 2:
+        return True
+
+    other_1, other_2, same = OPPOSITE[suite]
+    other_1 = packed[FOUNDATIONS_OFFSET + other_1]
+    other_2 = packed[FOUNDATIONS_OFFSET + other_2]
+    if other_1 >= value - 1 and other_2 >= value - 1:
+        return True
+    same = packed[FOUNDATIONS_OFFSET + same]
+    return other_1 >= value - 2 and other_2 >= value - 2 and same >= value - 3
+
+def autoplay(packed):
+    """
+    Move every safe card to the foundations, until none are left. Works on
+    the raw bytes, so the Tableau hashes are not updated; replay the
+    returned moves on a Tableau instead of passing its packed table.
+    :param bytearray packed: Packed table, modified in place
+    :return: (source, dest) pairs of the cards moved
+    :rtype: list[(str, str)]
+    """
+    moves = []
+    found = True
+    while found:
+        found = False
+        for cellno in range(NUM_CELLS):
+            code = packed[CELLS_OFFSET + cellno]
+            if code != NO_CARD and can_autoplay(packed, code):
+                packed[CELLS_OFFSET + cellno] = NO_CARD
+                packed[FOUNDATIONS_OFFSET + CARD_SUITE[code]] += 1
+                moves.append(("T%d" % cellno, "F%s" % SUITES[CARD_SUITE[code]]))
+                found = True
+        for colno in range(NUM_COLUMNS):
+            height = packed[HEIGHTS_OFFSET + colno]
+            if height == 0:
+                continue
+            slot = COLUMNS_OFFSET + colno * COLUMN_SIZE + height - 1
+            code = packed[slot]
+            if can_autoplay(packed, code):
+                packed[slot] = 0
+                packed[HEIGHTS_OFFSET + colno] = height - 1
+                packed[FOUNDATIONS_OFFSET + CARD_SUITE[code]] += 1
+                moves.append(("C%d" % colno, "F%s" % SUITES[CARD_SUITE[code]]))
+                found = True
+    return moves
+
+def empty_tableau():
+    """
+    :rtype: bytearray
+    """
+    packed = bytearray(TABLEAU_SIZE)
+    packed[CELLS_OFFSET:CELLS_OFFSET + NUM_CELLS] = bytearray([NO_CARD] * NUM_CELLS)
+    return packed
+
 class Tableau(object):
-    def setup(self, deck):
-        self.columns = [[], [], [], [], [], [], [], []]
-        """:type: list[list[Card]]"""
-        self.free_cells = [None, None, None, None]
-        """:type: list[Card | None]"""
-        self.foundations = {"c":[], "d": [], "h": [], "s": []}
-        """:type: dict[str, list[Card]]"""
+    """
+    Table state packed into a fixed size bytearray (see the layout above).
+    columns, free_cells and foundations are read-only Card views built on
+    access; modify the table through move() and state.
+
+    hash is a 64-bit Zobrist hash of the position, kept up to date by every
+    change. canonical_hash() also ignores free cell and column order.
+    """
+    def __init__(self):
+        self.packed = empty_tableau()
+        """:type: bytearray"""
+        self.rehash()
 
+    def setup(self, deck):
+        self.packed = empty_tableau()
+        self.rehash()
         for i in range(52):
-            self.columns[i%8].append(deck.deal())
+            self.push_column(i%8, deck.deal().code)
+
+    def copy(self):
+        """
+        :rtype: Tableau
+        """
+        table = Tableau.__new__(Tableau)
+        table.packed = bytearray(self.packed)
+        table.hash = self.hash
+        table.foundation_hash = self.foundation_hash
+        table.free_cell_hash = self.free_cell_hash
+        table.column_hashes = list(self.column_hashes)
+        return table
+
+    def rehash(self):
+        """
+        Compute the hashes from scratch.
+        """
+        packed = self.packed
+        self.hash = 0
+        """:type: int"""
+        self.foundation_hash = 0
+        self.free_cell_hash = 0
+        self.column_hashes = [0] * NUM_COLUMNS
+        """:type: list[int] (column hashes for canonical_hash, keyed by depth only)"""
+
+        for suite in range(4):
+            self.foundation_hash ^= FOUNDATION_KEYS[suite * 14 + packed[FOUNDATIONS_OFFSET + suite]]
+        self.hash ^= self.foundation_hash
+
+        for cellno in range(NUM_CELLS):
+            code = packed[CELLS_OFFSET + cellno]
+            if code != NO_CARD:
+                self.hash ^= CELL_KEYS[cellno * NUM_CARDS + code]
+                self.free_cell_hash ^= FREE_CELL_KEYS[code]
+
+        for colno in range(NUM_COLUMNS):
+            start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+            for depth in range(packed[HEIGHTS_OFFSET + colno]):
+                code = packed[start + depth]
+                self.hash ^= COLUMN_KEYS[(colno * COLUMN_SIZE + depth) * NUM_CARDS + code]
+                self.column_hashes[colno] ^= DEPTH_KEYS[depth * NUM_CARDS + code]
+
+    def canonical_hash(self):
+        """
+        Hash that is equal for positions that only differ in the order of
+        their free cells or columns.
+        :rtype: int
+        """
+        canonical = self.foundation_hash ^ self.free_cell_hash
+        for column_hash in self.column_hashes:
+            canonical ^= _mix_column(column_hash)
+        return canonical
 
     @property
     def state(self):
-        state = State(foundations=copy.deepcopy(self.foundations),
-                  cells = list(self.free_cells),
-                  columns = copy.deepcopy(self.columns))
-        return state
+        """
+        Immutable snapshot of the packed table.
+        :rtype: bytes
+        """
+        return bytes(self.packed)
 
     @state.setter
     def state(self, state):
-        self.foundations = state.foundations
-        self.free_cells = state.cells
-        self.columns = state.columns
+        if isinstance(state, State):
+            self.packed = empty_tableau()
+            for suite, foundation in state.foundations.items():
+                self.packed[FOUNDATIONS_OFFSET + SUITE_INDEX[suite]] = len(foundation)
+            for cellno, card in enumerate(state.cells):
+                if card is not None:
+                    self.packed[CELLS_OFFSET + cellno] = card.code
+            for colno, column in enumerate(state.columns):
+                start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+                for depth, card in enumerate(column):
+                    self.packed[start + depth] = card.code
+                self.packed[HEIGHTS_OFFSET + colno] = len(column)
+        else:
+            self.packed = bytearray(state)
+        self.rehash()
 
-    def get_card(self, source):
+    @property
+    def columns(self):
+        """:rtype: list[list[Card]]"""
+        return [self.column(colno) for colno in range(NUM_COLUMNS)]
+
+    @property
+    def free_cells(self):
+        """:rtype: list[Card | None]"""
+        return [None if code == NO_CARD else CARDS[code]
+                for code in self.packed[CELLS_OFFSET:CELLS_OFFSET + NUM_CELLS]]
+
+    @property
+    def foundations(self):
+        """:rtype: dict[str, list[Card]]"""
+        return {suite: [CARDS[(value - 1) * 4 + index] for value in range(1, self.packed[FOUNDATIONS_OFFSET + index] + 1)]
+                for index, suite in enumerate(SUITES)}
+
+    def column(self, colno):
+        """
+        :param int colno:
+        :rtype: list[Card]
+        """
+        start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+        return [CARDS[code] for code in self.packed[start:start + self.packed[HEIGHTS_OFFSET + colno]]]
+
+    def column_height(self, colno):
+        """
+        :param int colno:
+        :rtype: int
+        """
+        return self.packed[HEIGHTS_OFFSET + colno]
+
+    def foundation_value(self, suite):
+        """
+        :param str suite:
+        :return: Value of the top card of the foundation, 0 if empty
+        :rtype: int
+        """
+        return self.packed[FOUNDATIONS_OFFSET + SUITE_INDEX[suite]]
+
+    def push_column(self, colno, code):
+        height = self.packed[HEIGHTS_OFFSET + colno]
+        self.packed[COLUMNS_OFFSET + colno * COLUMN_SIZE + height] = code
+        self.packed[HEIGHTS_OFFSET + colno] = height + 1
+        self.hash ^= COLUMN_KEYS[(colno * COLUMN_SIZE + height) * NUM_CARDS + code]
+        self.column_hashes[colno] ^= DEPTH_KEYS[height * NUM_CARDS + code]
+
+    def pop_column(self, colno):
+        height = self.packed[HEIGHTS_OFFSET + colno] - 1
+        self.packed[HEIGHTS_OFFSET + colno] = height
+        slot = COLUMNS_OFFSET + colno * COLUMN_SIZE + height
+        code = self.packed[slot]
+        # Keep unused slots zeroed so equal tables have equal bytes
+        self.packed[slot] = 0
+        self.hash ^= COLUMN_KEYS[(colno * COLUMN_SIZE + height) * NUM_CARDS + code]
+        self.column_hashes[colno] ^= DEPTH_KEYS[height * NUM_CARDS + code]
+        return code
+
+    def set_cell(self, cellno, code):
+        """
+        :param int cellno: Free cell
+        :param int code: Card code, NO_CARD to empty the cell
+        """
+        old = self.packed[CELLS_OFFSET + cellno]
+        if old != NO_CARD:
+            self.hash ^= CELL_KEYS[cellno * NUM_CARDS + old]
+            self.free_cell_hash ^= FREE_CELL_KEYS[old]
+        if code != NO_CARD:
+            self.hash ^= CELL_KEYS[cellno * NUM_CARDS + code]
+            self.free_cell_hash ^= FREE_CELL_KEYS[code]
+        self.packed[CELLS_OFFSET + cellno] = code
+
+    def add_foundation(self, suite, delta):
+        """
+        :param int suite: Suite index
+        :param int delta: +1 to put a card on the foundation, -1 to take it off
+        """
+        height = self.packed[FOUNDATIONS_OFFSET + suite]
+        delta_hash = FOUNDATION_KEYS[suite * 14 + height] ^ FOUNDATION_KEYS[suite * 14 + height + delta]
+        self.hash ^= delta_hash
+        self.foundation_hash ^= delta_hash
+        self.packed[FOUNDATIONS_OFFSET + suite] = height + delta
+
+    def get_code(self, source):
         """
         :param str source:
-        :rtype: Card|None
+        :return: Card code, NO_CARD if there is no card
+        :rtype: int
         """
         source_type, index = source[0], source[1:]
+        packed = self.packed
 
         if source_type == "C":
-            column = self.columns[int(index)]
-            if len(column) == 0:
-                return None
-            else:
-                return column[-1]
+            colno = int(index)
+            height = packed[HEIGHTS_OFFSET + colno]
+            if height == 0:
+                return NO_CARD
+            return packed[COLUMNS_OFFSET + colno * COLUMN_SIZE + height - 1]
         elif source_type == "T":
-            return self.free_cells[int(index)]
+            return packed[CELLS_OFFSET + int(index)]
         elif source_type == "F":
-            foundation = self.foundations[index]
-            if len(foundation) == 0:
-                return None
-            else:
-                return foundation[-1]
+            suite_index = SUITE_INDEX[index]
+            value = packed[FOUNDATIONS_OFFSET + suite_index]
+            if value == 0:
+                return NO_CARD
+            return (value - 1) * 4 + suite_index
+        return NO_CARD
+
+    def get_card(self, source):
+        """
+        :param str source:
+        :rtype: Card|None
+        """
+        code = self.get_code(source)
+        if code == NO_CARD:
+            return None
+        return CARDS[code]
+
+    def can_move(self, source, dest):
+        """
+        Whether moving the top card of source onto dest is legal.
+        :param str source: Column or free cell
+        :param str dest: Column, free cell or foundation
+        :rtype: bool
+        """
+        if source[0] not in ("C", "T") or source == dest:
+            return False
+        code = self.get_code(source)
+        if code == NO_CARD:
+            return False
+
+        dest_type = dest[0]
+        if dest_type == "C":
+            top = self.get_code(dest)
+            return top == NO_CARD or CAN_STACK[top * NUM_CARDS + code] == 1
+        elif dest_type == "T":
+            return self.get_code(dest) == NO_CARD
+        elif dest_type == "F":
+            return dest[1:] == SUITES[CARD_SUITE[code]] and \
+                self.packed[FOUNDATIONS_OFFSET + CARD_SUITE[code]] == CARD_VALUE[code] - 1
+        return False
 
     def move(self, source, dest):
         source_type, source_index = source[0], source[1:]
@@ -118,33 +481,69 @@ class Tableau(object):
         dest_type, dest_index = dest[0], dest[1:]
         assert dest_type in ("C", "T", "F")
 
-        card = self.get_card(source)
-        assert card is not None
+        code = self.get_code(source)
+        assert code != NO_CARD
 
         if source_type == "C":
-            self.columns[int(source_index)].pop()
+            self.pop_column(int(source_index))
         elif source_type == "T":
-            self.free_cells[int(source_index)] = None
+            self.set_cell(int(source_index), NO_CARD)
+
+        if dest_type == "C":
+            self.push_column(int(dest_index), code)
+        elif dest_type == "T":
+            self.set_cell(int(dest_index), code)
+        elif dest_type == "F":
+            self.add_foundation(CARD_SUITE[code], 1)
+
+    def move_sequence(self, source, dest, num):
+        """
+        Move the top num cards of a column onto another as one block.
+        :param int source: Source column
+        :param int dest: Destination column
+        :param int num: Number of cards
+        """
+        codes = [self.pop_column(source) for i in range(num)]
+        for code in reversed(codes):
+            self.push_column(dest, code)
+
+    def unmove(self, source, dest):
+        """
+        Reverse a move(source, dest), taking the card back off dest.
+        """
+        source_type, source_index = source[0], source[1:]
+        assert source_type in ("C", "T")
+        dest_type, dest_index = dest[0], dest[1:]
+        assert dest_type in ("C", "T", "F")
+
+        code = self.get_code(dest)
+        assert code != NO_CARD
 
         if dest_type == "C":
-            self.columns[int(dest_index)].append(card)
+            self.pop_column(int(dest_index))
         elif dest_type == "T":
-            self.free_cells[int(dest_index)] = card
+            self.set_cell(int(dest_index), NO_CARD)
         elif dest_type == "F":
-            self.foundations[dest_index].append(card)
+            self.add_foundation(CARD_SUITE[code], -1)
+
+        if source_type == "C":
+            self.push_column(int(source_index), code)
+        elif source_type == "T":
+            self.set_cell(int(source_index), code)
 
     def __str__(self):
         ret_str = ""
         row = []
+        columns = self.columns
         for i in range(52):
             if i % 8 == 0 and i > 1:
                 ret_str += " ".join(row)
                 ret_str += "\n"
                 row = []
-            row.append(str(self.columns[i%8][i/8]))
+            row.append(str(columns[i%8][i/8]))
 
         ret_str += " ".join(row)
         return ret_str
 
     def height(self):
-        return max([len(x) for x in self.columns])
+        return max(self.packed[HEIGHTS_OFFSET:HEIGHTS_OFFSET + NUM_COLUMNS])
@@ -9,11 +9,12 @@ from network import FreeCellNetworking
 
 
 class FreeCellGame(object):
-    def __init__(self, seed=None, debug=False, networking=False):
+    def __init__(self, seed=None, debug=False, networking=False, room=None):
         """
         :param int seed: Seed
         :param bool debug: Debug enabled
         :param bool networking: Networking enabled
+        :param str room: Competition room to join, the server's default room if None
         """
         self.event_dispatch = events.event_dispatch
         self.logic = FreeCellLogic()
@@ -22,6 +23,7 @@ class FreeCellGame(object):
         self.stats = None
         self.seed = None
         self.debug = debug
+        self.room = room
         self.networking = None
         self.shutdown_event = threading.Event()
         self.quit_message = None
@@ -49,6 +51,8 @@ class FreeCellGame(object):
         self.event_dispatch.register(self.quit, ["QuitEvent"])
         self.event_dispatch.register(self.set_seed, ["SeedEvent"])
         self.event_dispatch.register(self.handle_input, ["InputEvent"])
+        if self.room is not None:
+            self.event_dispatch.register(self.join_room, ["LoggedInEvent"])
         for thread in self.threads:
             thread.start()
         self.shutdown_event.set()
@@ -57,6 +61,10 @@ class FreeCellGame(object):
         self.gui.start(stdscr)
         self.game_loop()
 
+    def join_room(self, event):
+        # Sent before the load screen asks for a seed, so the seed comes from this room
+        self.event_dispatch.send(JoinRoomEvent(room=self.room))
+
     def set_seed(self, event):
         self.state = "seeded"
         self.seed = event.seed
@@ -94,7 +102,7 @@ class FreeCellGame(object):
 
     def finish(self, event):
         if self.seed is not None:
-            self.stats = Stats(seed=self.seed, time=time.time()-self.logic.start_time, moves=self.logic.moves, undos=self.logic.undos, won=self.logic.is_solved())
+            self.stats = Stats(seed=self.seed, time=time.time()-self.logic.start_time, moves=self.logic.moves, undos=self.logic.undos, won=self.logic.is_solved(), log=self.logic.history.log)
             self.event_dispatch.send(self.stats)
             if self.stats.won:
                 message = "You won!"
@@ -1,7 +1,11 @@
 import curses
 import hashlib
+import json
 import os.path
 
+from collections import deque
+
+from board import can_autoplay
 from events import *
 import events
 from input import CursesInput
@@ -83,9 +87,24 @@ class GUIState(object):
         pass
 
 class LoginGUI(GUIState):
+    """
+    Logs in with one auth message when it can: with the ticket from the
+    last login if it has not expired, or with the nonce from welcome and the
+    salt remembered from the last challenge. Otherwise, or if that fails,
+    it goes through login, nonce and tokenhash.
+    """
+    SESSION_PATH = "~/.freecell_session"
     username = ""
     token = ""
     message = ("", 0)
+    def __init__(self, window):
+        GUIState.__init__(self, window)
+        self.nonce = None
+        """:type : int | None (from welcome, None from older servers)"""
+        # Both can arrive while another screen is loaded
+        self.event_dispatch.register(self.challenge, ["ChallengeEvent"])
+        self.event_dispatch.register(self.save_ticket, ["TicketEvent"])
+
     def load(self):
         self.event_dispatch.register(self.handle_input, ["InputEvent"])
 
@@ -94,6 +113,33 @@ class LoginGUI(GUIState):
         self.event_dispatch.unregister(self.login_reply, ["NonceEvent", "UnknownUserEvent"])
         self.event_dispatch.unregister(self.register_reply, ["NameTakenEvent", "LoginTokenEvent"])
         self.event_dispatch.unregister(self.challenge_response, ["LoggedInEvent", "LoginFailedEvent"])
+        self.event_dispatch.unregister(self.auth_reply, ["LoggedInEvent", "LoginFailedEvent", "UnknownUserEvent"])
+
+    def load_sessions(self):
+        """
+        :return: Salt, ticket and ticket expiry by username
+        :rtype: dict[str, dict]
+        """
+        try:
+            with open(os.path.expanduser(self.SESSION_PATH)) as session_file:
+                return json.load(session_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save_session(self, username, **values):
+        sessions = self.load_sessions()
+        sessions.setdefault(username, {}).update(values)
+        with open(os.path.expanduser(self.SESSION_PATH), "w") as session_file:
+            json.dump(sessions, session_file)
+
+    def forget_session(self, username):
+        sessions = self.load_sessions()
+        if sessions.pop(username, None) is not None:
+            with open(os.path.expanduser(self.SESSION_PATH), "w") as session_file:
+                json.dump(sessions, session_file)
+
+    def nonce_hash(self, salt, nonce):
+        return hashlib.sha256(hashlib.sha256(self.token+salt).hexdigest()+str(nonce)).hexdigest()
 
     def render(self):
         self.window.erase()
@@ -117,6 +163,7 @@ class LoginGUI(GUIState):
             if os.path.isfile(os.path.expanduser("~/.freecell_token")):
                 with open(os.path.expanduser("~/.freecell_token")) as token_file:
                     self.token = token_file.read(16)
+                if not self.authenticate():
                     self.event_dispatch.register(self.login_reply, ["NonceEvent", "UnknownUserEvent"])
                     self.event_dispatch.send(LoginEvent(username=self.username))
             else:
@@ -146,8 +193,8 @@ class LoginGUI(GUIState):
             self.username = ""
         elif isinstance(event, NonceEvent):
             self.event_dispatch.register(self.challenge_response, ["LoggedInEvent", "LoginFailedEvent"])
-            nonce_hash = hashlib.sha256(hashlib.sha256(self.token+event.salt).hexdigest()+str(event.nonce)).hexdigest()
-            self.event_dispatch.send(TokenHashEvent(self.username, nonce_hash))
+            self.save_session(self.username, salt=event.salt)
+            self.event_dispatch.send(TokenHashEvent(self.username, self.nonce_hash(event.salt, event.nonce)))
             self.message = ("Nonce received, sending back hash", time.time())
 
     def challenge_response(self, event):
@@ -160,6 +207,45 @@ class LoginGUI(GUIState):
             self.message = ("Login failed with '%s'" % self.username, time.time())
             self.username = ""
 
+    def challenge(self, event):
+        self.nonce = event.nonce
+
+    def save_ticket(self, event):
+        self.save_session(event.username, ticket=event.ticket, expires=event.expires)
+
+    def authenticate(self):
+        """
+        Send auth if there is a ticket or the server's nonce and a salt to answer it with.
+        :return: False if login has to go through the challenge
+        :rtype: bool
+        """
+        session = self.load_sessions().get(self.username, {})
+        ticket = session.get("ticket", "") if session.get("expires", 0) > time.time() else ""
+        salt = session.get("salt")
+        nonce_hash = self.nonce_hash(str(salt), self.nonce) if salt and self.nonce is not None else ""
+        if not ticket and not nonce_hash:
+            return False
+        self.event_dispatch.register(self.auth_reply, ["LoggedInEvent", "LoginFailedEvent", "UnknownUserEvent"])
+        self.event_dispatch.send(AuthRequestEvent(username=self.username, nonce_hash=nonce_hash, ticket=ticket))
+        self.message = ("Logging in", time.time())
+        return True
+
+    def auth_reply(self, event):
+        self.event_dispatch.unregister(self.auth_reply, ["LoggedInEvent", "LoginFailedEvent", "UnknownUserEvent"])
+        if isinstance(event, LoggedInEvent):
+            self.event_dispatch.send(ScreenChangeEvent(screen="load"))
+            self.message = ("Logged in with '%s'" % self.username, time.time())
+        elif isinstance(event, UnknownUserEvent):
+            self.forget_session(self.username)
+            self.event_dispatch.register(self.handle_input, ["InputEvent"])
+            self.message = ("Unknown user '%s'" % self.username, time.time())
+            self.username = ""
+        elif isinstance(event, LoginFailedEvent):
+            # Stale ticket or salt, take the long way
+            self.forget_session(self.username)
+            self.event_dispatch.register(self.login_reply, ["NonceEvent", "UnknownUserEvent"])
+            self.event_dispatch.send(LoginEvent(username=self.username))
+
 
 class LoadGUI(GUIState):
 
@@ -235,11 +321,67 @@ class HelpGUI(GUIState):
         else:
             self.window.addstr(1, 1, "Out of help!")
 
+class MoveAnimator(object):
+    """
+    Paces moves that the logic has already applied. While moves are pending
+    it keeps its own copy of the table and applies one move every few
+    frames; once they have all been shown it hands back the logic's table.
+    """
+    FRAMES_PER_MOVE = 3
+    FRAMES_PER_AUTOMOVE = 2
+
+    def __init__(self, logic):
+        """
+        :param FreeCellLogic logic: Logic
+        """
+        self.logic = logic
+        self.table = None
+        """:type : Tableau | None"""
+        self.pending = deque()
+        self.wait = 0
+
+    def moves_applied(self, event):
+        if self.table is None:
+            # The logic's table is right after these moves, step back from it
+            self.table = self.logic.table.copy()
+            for source, dest in reversed(event.moves):
+                self.table.unmove(source, dest)
+            self.wait = 0
+
+        frames = self.FRAMES_PER_AUTOMOVE if event.auto else self.FRAMES_PER_MOVE
+        for move in event.moves:
+            self.pending.append((move, frames))
+
+    def reset(self):
+        self.pending.clear()
+        self.table = None
+
+    def update(self):
+        """
+        Advance one frame.
+        :return: Table to draw
+        :rtype: Tableau
+        """
+        if self.table is None:
+            return self.logic.table
+
+        if self.wait > 0:
+            self.wait -= 1
+        elif len(self.pending) > 0:
+            (source, dest), frames = self.pending.popleft()
+            self.table.move(source, dest)
+            self.wait = frames - 1
+        else:
+            self.table = None
+            return self.logic.table
+        return self.table
+
 class GameGUI(GUIState):
     def __init__(self, window, logic):
         GUIState.__init__(self, window)
         self.input_buffer = []
         self.logic = logic
+        self.animator = MoveAnimator(logic)
         self.face_dir = 1
 
         # for selection
@@ -252,20 +394,24 @@ class GameGUI(GUIState):
         self.event_dispatch.register(self.handle_input, ["InputEvent"])
         self.event_dispatch.register(self.pause_input, ["InputFlowEvent"])
         self.event_dispatch.register(self.display_message, ["MessageEvent"])
+        self.event_dispatch.register(self.animator.moves_applied, ["MovesAppliedEvent"])
 
     def unload(self):
         self.event_dispatch.unregister(self.handle_input, ["InputEvent"])
         self.event_dispatch.unregister(self.pause_input, ["InputFlowEvent"])
         self.event_dispatch.unregister(self.display_message, ["MessageEvent"])
         self.event_dispatch.unregister(self.buffer_input, ["InputEvent"])
+        self.event_dispatch.unregister(self.animator.moves_applied, ["MovesAppliedEvent"])
+        self.animator.reset()
 
     def render(self):
-        self.render_base()
-        self.render_cards()
+        table = self.animator.update()
+        self.render_base(table)
+        self.render_cards(table)
         self.window.refresh()
-        self.window.move(5 + self.logic.table.height(), 43)
+        self.window.move(5 + table.height(), 43)
 
-    def render_base(self):
+    def render_base(self, table):
         self.window.erase()
         self.window.addstr(0, 0, "space                                  enter")
         seed_str = "#%d" % self.logic.seed
@@ -282,7 +428,7 @@ class GameGUI(GUIState):
             self.window.attrset(curses.A_BOLD | curses.color_pair(4))
             self.window.addstr(1, 21, ("(=", "=)")[self.face_dir])
             self.window.attrset(curses.A_NORMAL)
-        height = self.logic.table.height()
+        height = table.height()
 
         self.window.addstr(5 + height, 0, "    a    b    c    d    e    f    g    h")
         statusline = "%d move%s, %d undo%s" % (self.logic.moves, ["s",""][self.logic.moves == 1],
@@ -295,9 +441,9 @@ class GameGUI(GUIState):
         self.window.addch(6 + height, 10, '?')
         self.window.attrset(curses.A_NORMAL)
 
-    def render_cards(self):
+    def render_cards(self, table):
         # Cells
-        for cellno, card in enumerate(self.logic.table.free_cells):
+        for cellno, card in enumerate(table.free_cells):
             if card is not None:
                 selected = isinstance(self.selected, CellSelection) \
                            and self.selected.cell == cellno
@@ -308,20 +454,20 @@ class GameGUI(GUIState):
 
         suites = "hsdc"
         for foundno, suite in enumerate(suites):
-            card = self.logic.table.get_card("F%s" % suite)
+            card = table.get_card("F%s" % suite)
             if card is not None:
                 self.window.move(1, 25 + 5 * foundno)
                 self.render_card(card)
 
         # Render cards
-        for colno, column in enumerate(self.logic.table.columns):
+        for colno, column in enumerate(table.columns):
             selected = isinstance(self.selected, ColumnSelection) \
                        and self.selected.col == colno
 
             if selected:
                 num = self.selected.num
 
-            if len(column) > 0 and len(column) == len(self.logic.contiguous_range(colno)):
+            if len(column) > 0 and len(column) == len(self.logic.contiguous_range(colno, table)):
                 self.window.move(3, 3 + 5 * colno)
                 self.window.attrset(curses.color_pair(7))
                 self.window.addstr("   ")
@@ -329,7 +475,7 @@ class GameGUI(GUIState):
 
             for cardno, card in enumerate(column):
                 self.window.move(4 + cardno, 3 + 5 * colno)
-                will_move = self.logic.can_automove(card)
+                will_move = can_autoplay(table.packed, card.code)
                 self.render_card(card, selected and cardno >= (len(column) - num), will_move)
 
     def render_card(self, card, selected=False, will_move=False):
@@ -404,6 +550,7 @@ class GameGUI(GUIState):
         # u Undo
         elif key == ord('u'):
             self.logic.pop_undo()
+            self.animator.reset()
             self.selected = None
 
         # Escape Unselect
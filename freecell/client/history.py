@@ -0,0 +1,87 @@
+from collections import namedtuple
+
+# Entries between full table snapshots, 0 disables checkpoints
+CHECKPOINT_INTERVAL = 32
+
+JournalEntry = namedtuple('JournalEntry', ['moves', 'checkpoint'])
+
+# Action log markers, see UndoJournal.log
+LOG_UNDO = "u"
+LOG_ROLLBACK = "r"
+
+def encode_moves(moves):
+    """
+    :param tuple[(str, str)] moves: (source, dest) pairs
+    :return: Locations concatenated, two characters each ("C3T0T0Fh")
+    :rtype: str
+    """
+    return "".join(source + dest for source, dest in moves)
+
+def decode_moves(action):
+    """
+    :param str action: Output of encode_moves()
+    :rtype: list[(str, str)]
+    """
+    return [(action[i:i+2], action[i+2:i+4]) for i in range(0, len(action), 4)]
+
+class UndoJournal(object):
+    """
+    Undo history that records the applied moves instead of table copies.
+    Undoing an entry applies the inverse moves, so both cost O(1) per move.
+    Every CHECKPOINT_INTERVAL entries the table snapshot from before the
+    entry is kept as well, and undo restores it directly.
+
+    log keeps every action in order, undone or not: encode_moves() of each
+    entry, LOG_UNDO for an undo and LOG_ROLLBACK for an automatic one. It
+    is what gets submitted for replay validation.
+    """
+    def __init__(self, table, checkpoint_interval=CHECKPOINT_INTERVAL):
+        """
+        :param board.Tableau table: Table the moves are applied to
+        :param int checkpoint_interval: Entries between snapshots
+        """
+        self.table = table
+        self.checkpoint_interval = checkpoint_interval
+        self.entries = []
+        """:type: list[JournalEntry]"""
+        self.log = []
+        """:type: list[str]"""
+
+    def __len__(self):
+        return len(self.entries)
+
+    def apply(self, moves):
+        """
+        Apply moves to the table and record them as one entry.
+        :param tuple[(str, str)] moves: (source, dest) pairs
+        """
+        checkpoint = None
+        if self.checkpoint_interval and len(self.entries) % self.checkpoint_interval == 0:
+            checkpoint = self.table.state
+
+        for source, dest in moves:
+            self.table.move(source, dest)
+        self.entries.append(JournalEntry(moves=tuple(moves), checkpoint=checkpoint))
+        self.log.append(encode_moves(moves))
+
+    def pop(self, auto=False):
+        """
+        Revert the last entry on the table.
+        :param bool auto: Rollback by the game rather than an undo by the player
+        :rtype: JournalEntry | None
+        """
+        if len(self.entries) == 0:
+            return None
+
+        entry = self.entries.pop()
+        self.log.append(LOG_ROLLBACK if auto else LOG_UNDO)
+        if entry.checkpoint is not None:
+            self.table.state = entry.checkpoint
+        else:
+            for source, dest in reversed(entry.moves):
+                self.table.unmove(source, dest)
+        return entry
+
+    def clear(self):
+        self.entries = []
+        self.log = []
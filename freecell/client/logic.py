@@ -1,18 +1,23 @@
-import copy
-
-from board import Tableau, Deck
+from board import Tableau, Deck, max_sequence, can_autoplay, autoplay, SUITES, NO_CARD, NUM_CELLS, NUM_COLUMNS, NUM_CARDS, \
+    CARD_VALUE, CARD_SUITE, CAN_STACK, CELLS_OFFSET, FOUNDATIONS_OFFSET, HEIGHTS_OFFSET, COLUMNS_OFFSET, COLUMN_SIZE
 from events import *
 import events
+from history import UndoJournal
 
 
 class FreeCellLogic(object):
-    def __init__(self):
+    def __init__(self, headless=False):
+        """
+        :param bool headless: Don't report applied moves, nothing will animate them
+        """
         self.deck = Deck()
         self.table = Tableau()
         self.event_dispatch = events.event_dispatch
+        self.headless = headless
 
     def start(self):
         self.event_dispatch.register(self.process_move, ["MoveEvent"])
+        self.event_dispatch.register(self.process_compound_move, ["CompoundMoveEvent"])
         self.event_dispatch.register(self.automove, ["MoveCompleteEvent"])
 
     def load_seed(self, seed):
@@ -22,93 +27,60 @@ class FreeCellLogic(object):
 
         self.start_time = time.time()
 
-        self.history = []
+        self.history = UndoJournal(self.table)
         self.solved = False
         self.moves = 0
         self.undos = 0
-        self.move_queue = []
 
         self.automove()
 
     def can_automove(self, card):
-        foundations = self.table.foundations
-        if len(foundations[card.suite]) == 0:
-            if card.value != 1:
-                return False
-            else:
-                return True
-
-        if not foundations[card.suite][-1].value == card.value - 1:
-            return False
-
-        red = ["h","d"]
-        black = ["c","s"]
-
-        if card.suite in red:
-            this = red
-            other = black
-        else:
-            this = black
-            other = red
-
-        this.remove(card.suite)
-
-
-        # 0 if empty, value otherwise
-        other_1 = len(foundations[other[0]]) > 0 and foundations[other[0]][-1].value
-        other_2 = len(foundations[other[1]]) > 0 and foundations[other[1]][-1].value
-
-        same = len(foundations[this[0]]) > 0 and foundations[this[0]][-1].value
-
-        # The required logic breaks my head, so here's a helper function
-        this_can_stack = lambda this, other: other > this
-
-        free_to_stack = lambda this, other_1, other_2: other_1 >= this - 1 and other_2 >= this - 1
-
-        # If there is nothing to put on this card on the main board
-        # (The values of the stacks are at least the values of potentially stackable card)
-        if free_to_stack(card.value, other_1, other_2):
-            return True
-
-        other_val = card.value - 1
-        # If EVERY other card that could be stacked is eligible itself for automove and has nothing that can stack on it
-        #   other_1 has a stack
-        # The "EVERY other cards" are free to stack
-        #             can_stack                    can_stack                 can_stack a card that's -1
-        if other_1 >= other_val - 1 and other_2 >= other_val - 1 and same >= other_val - 1 - 1:
-            return True
-
-        return False
+        return can_autoplay(self.table.packed, card.code)
 
     def automove(self, event=None):
-        found_moves = False
-        for cellno, card in enumerate(self.table.free_cells):
-            if card is not None and self.can_automove(card):
-                found_moves = True
-                self.event_dispatch.send(MoveEvent(source="T%d" % cellno, dest="F%s" % card.suite, num=1))
-
-        for colno, column in enumerate(self.table.columns):
-            if len(column) > 0 and self.can_automove(column[-1]):
-                found_moves = True
-                self.event_dispatch.send(MoveEvent(source="C%d" % colno, dest="F%s" % column[-1].suite, num=1))
+        """
+        Play the whole safe cascade to the foundations as one batch.
+        """
+        moves = autoplay(bytearray(self.table.packed))
+        if len(moves) > 0:
+            self.push_undo(moves)
+            self.notify_moves(moves, auto=True)
+            self.check_solved()
+        return moves
+
+    def notify_moves(self, moves, auto=False):
+        """
+        Report moves already applied to the table, so the GUI can pace them.
+        Sent ahead of everything else queued, so the table the handler sees
+        is the one right after these moves.
+        """
+        if not self.headless:
+            self.event_dispatch.send(MovesAppliedEvent(moves=tuple(moves), auto=auto), priority=1)
 
-        if found_moves:
-            self.event_dispatch.send(MoveCompleteEvent(unused=''))
+    def check_solved(self):
+        if not self.solved and self.is_solved():
+            self.solved = True
+            self.event_dispatch.send(FinishEvent(won=True))
 
     def is_solved(self):
-        for foundation in self.table.foundations.values():
-            if len(foundation) == 0 or foundation[-1].value != 13:
+        for suite in SUITES:
+            if self.table.foundation_value(suite) != 13:
                 return False
         return True
 
-    def push_undo(self):
-        self.history.append(self.table.state)
-        self.moves += 1
+    def push_undo(self, moves):
+        """
+        Apply moves to the table and record them as one undo entry. moves
+        counts single card moves, however they are batched for undo.
+        :param tuple[(str, str)] moves: (source, dest) pairs
+        """
+        self.history.apply(moves)
+        self.moves += len(moves)
 
     def pop_undo(self, auto=False):
-        if len(self.history) > 0:
-            self.table.state = self.history.pop()
-            self.moves -= 1
+        entry = self.history.pop(auto)
+        if entry is not None:
+            self.moves -= len(entry.moves)
             if not auto:
                 self.undos += 1
 
@@ -119,91 +91,144 @@ class FreeCellLogic(object):
         if length > len(available_cells):
             return False
 
-        for i in range(length):
-            cell = available_cells[i]
-            self.event_dispatch.send(MoveEvent(source=move_event.source, dest=cell, num=1))
-        self.event_dispatch.send(MoveCompleteEvent(unused=''))
-        return True
+        moves = [(move_event.source, cell) for cell in available_cells[:length]]
+        return self.apply_compound(moves)
 
     def make_supermove(self, event):
-        simple_state = {"free_cells": copy.deepcopy(self.table.free_cells),
-                        "columns": copy.deepcopy(self.table.columns)}
-
-        max_simple_move = len([x for x in simple_state["free_cells"] if x is None]) + 1
-        stack = self.table.columns[int(event.source[1:])][-event.num:]
-
-        available_cols = len([x for x in self.table.columns if len(x) == 0]) # this is a lower bound
-        # if you write an exploratory algorithm, you'll be able to use columns that can fit SOME part of your stack
-
-        if len(self.table.columns[int(event.dest[1:])]) == 0:
-            available_cols -= 1
+        source = int(event.source[1:])
+        dest = int(event.dest[1:])
+        if event.num > len(self.contiguous_range(source)):
+            return False
 
-        source_card = stack[0]
-        dest_col = simple_state["columns"][int(event.dest[1:])]
-        if len(dest_col) > 0 and not dest_col[-1].can_stack(source_card):
+        source_card = self.table.column(source)[-event.num]
+        dest_card = self.table.get_card(event.dest)
+        if dest_card is not None and not dest_card.can_stack(source_card):
             return False
 
-        if len(stack) > max_simple_move * (1 + available_cols):
+        moves = self.plan_supermove(source, dest, event.num)
+        if moves is None:
             return False
+        return self.apply_compound(moves)
 
-        #if len(stack) > max_simple_move * 2**available_cols:
-        #    return False
-
-        try:
-            self.move_queue = []
-            self.supermove(simple_state, stack, int(event.source[1:]), int(event.dest[1:]))
-            for move in self.move_queue:
-                self.event_dispatch.send(move)
-            self.event_dispatch.send(MoveCompleteEvent(unused=''))
-        except Exception as e:
-            self.event_dispatch.send(MessageEvent(level="error", message=str(e)))
-        return True
+    def plan_supermove(self, source, dest, num):
+        """
+        Plan moving the top num cards of a column onto another, one card at
+        a time, through free cells, empty columns and any column that can
+        hold part of the sequence. Works on the table with move/unmove and
+        leaves it unchanged.
+        :param int source: Source column
+        :param int dest: Destination column, must accept the base card
+        :param int num: Number of cards
+        :return: (source, dest) pairs, None if there is no room for the move
+        :rtype: list[(str, str)] | None
+        """
+        moves = []
+        if not self.plan_sequence(source, dest, num, moves):
+            return None
+        for move_source, move_dest in reversed(moves):
+            self.table.unmove(move_source, move_dest)
+        return moves
+
+    def plan_sequence(self, source, dest, num, moves):
+        """
+        Move a valid sequence of num cards from source to dest, appending
+        the moves made to moves. Backtracks and returns False on failure.
+        :rtype: bool
+        """
+        table = self.table
+        free_cells = [cell for cell in range(NUM_CELLS) if table.get_code("T%d" % cell) == NO_CARD]
+
+        # Base case, room to go through the free cells
+        if num <= len(free_cells) + 1:
+            used_cells = free_cells[:num-1]
+            for cell in used_cells:
+                self.apply_planned(moves, "C%d" % source, "T%d" % cell)
+            self.apply_planned(moves, "C%d" % source, "C%d" % dest)
+            for cell in reversed(used_cells):
+                self.apply_planned(moves, "T%d" % cell, "C%d" % dest)
+            return True
 
-    def simple_supermove(self, state, stack, source, dest):
-        state = copy.deepcopy(state)
-
-        used_cells = []
-        length = len(stack)
-        free_cells = [cell for cell, x in enumerate(state["free_cells"]) if x is None]
-        for i in range(length-1):
-            cell = free_cells.pop()
-            used_cells.append(cell)
-            self.move_queue.append(MoveEvent(source="C%d" % source, dest="T%d" % cell, num=1))
-        self.move_queue.append(MoveEvent(source="C%d" % source, dest="C%d" % dest, num=1))
-        # Reverse
-        for cell in reversed(used_cells):
-            self.move_queue.append(MoveEvent(source="T%d" % cell, dest="C%d" % dest, num=1))
-
-        state["columns"][dest].extend(state["columns"][source][-len(stack):])
-        state["columns"][source] = state["columns"][source][:-len(stack)]
-
-        return state
-
-    def supermove(self, state, stack, source, dest):
-        state = copy.deepcopy(state)
-        max_simple_move = len([x for x in state["free_cells"] if x is None]) + 1
-
-        remaining = len(stack) % max_simple_move
-        if remaining == 0:
-            remaining = max_simple_move
-        # Clear top of stack
-        if len(stack) > max_simple_move:
-            for colno, column in enumerate(state["columns"]):
-                if (len(column) == 0 or column[-1].can_stack(stack[remaining]) ) and colno != dest:
-                    free_col = colno
+        stack = table.column(source)[-num:]
+        empty_cols = [col for col in range(NUM_COLUMNS) if table.column_height(col) == 0 and col not in (source, dest)]
+
+        # Park the top of the stack on a temporary column: first any column
+        # that can hold part of it, then an empty one.
+        candidates = []
+        for col in range(NUM_COLUMNS):
+            if col in (source, dest) or table.column_height(col) == 0:
+                continue
+            top = table.get_card("C%d" % col)
+            for split in range(1, num):
+                if top.can_stack(stack[split]):
+                    candidates.append((col, num - split))
                     break
-            else:
-                raise Exception("Failed to generate supermove. This is a bug.")
-            state = self.supermove(state, stack[remaining:], source, free_col)
+        if len(empty_cols) > 0:
+            # Largest part that fits, with the rest still able to move
+            capacity = (len(free_cells) + 1) << (len(empty_cols) - 1)
+            if num - capacity <= capacity:
+                candidates.append((empty_cols[0], min(num - 1, capacity)))
+
+        mark = len(moves)
+        for temp, parked in candidates:
+            if self.plan_sequence(source, temp, parked, moves) \
+                    and self.plan_sequence(source, dest, num - parked, moves) \
+                    and self.plan_sequence(temp, dest, parked, moves):
+                return True
+            self.rewind(moves, mark)
+        return False
 
-        # Move base of stack (base case!)
-        state = self.simple_supermove(state, stack[:remaining], source, dest)
+    def apply_planned(self, moves, source, dest):
+        self.table.move(source, dest)
+        moves.append((source, dest))
 
-        # Put top of stack back onto base
-        if len(stack) > max_simple_move:
-            state = self.supermove(state, stack[remaining:], free_col, dest)
+    def rewind(self, moves, mark):
+        """
+        Undo planned moves back to mark.
+        """
+        while len(moves) > mark:
+            source, dest = moves.pop()
+            self.table.unmove(source, dest)
+
+    def process_compound_move(self, event):
+        """
+        :param CompoundMoveEvent event: Single card moves making up one action
+        :rtype: bool
+        """
+        return self.apply_compound(event.moves)
 
-        return state
+    def apply_compound(self, moves):
+        """
+        Validate and apply single card moves as one action: one undo entry
+        and one notification. Each card still counts as a move, as it did
+        when supermoves and fills were sent as separate MoveEvents. Nothing
+        is applied unless every move is legal in turn. The safe cascade is
+        played straight after, a supermove re-sent by process_move is
+        dispatched after the GUI's MoveCompleteEvent.
+        :param list[(str, str)] moves: (source, dest) pairs
+        :rtype: bool
+        """
+        if len(moves) == 0 or not self.can_apply(moves):
+            return False
+        self.push_undo(moves)
+        self.notify_moves(moves)
+        self.automove()
+        self.check_solved()
+        return True
+
+    def can_apply(self, moves):
+        """
+        Whether the moves are legal one after the other. Leaves the table unchanged.
+        :param list[(str, str)] moves: (source, dest) pairs
+        :rtype: bool
+        """
+        applied = []
+        for source, dest in moves:
+            if not self.table.can_move(source, dest):
+                break
+            self.apply_planned(applied, source, dest)
+        valid = len(applied) == len(moves)
+        self.rewind(applied, 0)
+        return valid
 
     def process_move(self, move_event):
         """
@@ -229,8 +254,6 @@ class FreeCellLogic(object):
         if card is None: # Can't move a nothing
             return False
 
-        self.push_undo()
-
         valid = False
         dest_card = self.table.get_card(move_event.dest)
 
@@ -264,27 +287,118 @@ class FreeCellLogic(object):
                     valid = True
 
         if valid:
-            self.table.move(move_event.source, move_event.dest)
-            if self.is_solved():
-                self.solved = True
-                self.event_dispatch.send(FinishEvent(won=True))
-            time.sleep(.1)
-        else:
-            self.pop_undo(auto=True)
+            moves = ((move_event.source, move_event.dest),)
+            self.push_undo(moves)
+            self.notify_moves(moves)
+            self.check_solved()
 
         return valid
 
-    def contiguous_range(self, column):
+    def legal_moves(self, state=None):
+        """
+        Every legal single card and sequence move from a position. Sequence
+        moves only go to columns and are limited by max_sequence().
+        :param Tableau state: Position, the current table by default. Not modified.
+        :rtype: collections.Iterator[MoveEvent]
+        """
+        if state is None:
+            state = self.table
+        packed = state.packed
+
+        free_cells = [cell for cell in range(NUM_CELLS) if packed[CELLS_OFFSET + cell] == NO_CARD]
+        empty_cols = [col for col in range(NUM_COLUMNS) if packed[HEIGHTS_OFFSET + col] == 0]
+        tops = [NO_CARD] * NUM_COLUMNS
+        for col in range(NUM_COLUMNS):
+            height = packed[HEIGHTS_OFFSET + col]
+            if height > 0:
+                tops[col] = packed[COLUMNS_OFFSET + col * COLUMN_SIZE + height - 1]
+
+        for cell in range(NUM_CELLS):
+            code = packed[CELLS_OFFSET + cell]
+            if code == NO_CARD:
+                continue
+            suite = CARD_SUITE[code]
+            if packed[FOUNDATIONS_OFFSET + suite] == CARD_VALUE[code] - 1:
+                yield MoveEvent(source="T%d" % cell, dest="F%s" % SUITES[suite], num=1)
+            for col in range(NUM_COLUMNS):
+                if tops[col] == NO_CARD or CAN_STACK[tops[col] * NUM_CARDS + code]:
+                    yield MoveEvent(source="T%d" % cell, dest="C%d" % col, num=1)
+
+        for col in range(NUM_COLUMNS):
+            height = packed[HEIGHTS_OFFSET + col]
+            if height == 0:
+                continue
+            start = COLUMNS_OFFSET + col * COLUMN_SIZE
+            code = tops[col]
+            suite = CARD_SUITE[code]
+
+            if packed[FOUNDATIONS_OFFSET + suite] == CARD_VALUE[code] - 1:
+                yield MoveEvent(source="C%d" % col, dest="F%s" % SUITES[suite], num=1)
+            for cell in free_cells:
+                yield MoveEvent(source="C%d" % col, dest="T%d" % cell, num=1)
+
+            run = 1
+            while run < height and CAN_STACK[packed[start + height - run - 1] * NUM_CARDS + packed[start + height - run]]:
+                run += 1
+
+            for dest in range(NUM_COLUMNS):
+                if dest == col:
+                    continue
+                if tops[dest] == NO_CARD:
+                    for num in range(1, min(run, max_sequence(len(free_cells), len(empty_cols) - 1)) + 1):
+                        yield MoveEvent(source="C%d" % col, dest="C%d" % dest, num=num)
+                else:
+                    num = CARD_VALUE[tops[dest]] - CARD_VALUE[code]
+                    if 1 <= num <= min(run, max_sequence(len(free_cells), len(empty_cols))) \
+                            and CAN_STACK[tops[dest] * NUM_CARDS + packed[start + height - num]]:
+                        yield MoveEvent(source="C%d" % col, dest="C%d" % dest, num=num)
+
+    def apply_move(self, move, state=None):
+        """
+        Apply a move from legal_moves(). Sequence moves are applied as one
+        block, without going through the free cells.
+        :param MoveEvent move: Move
+        :param Tableau state: Position, the current table by default
+        """
+        if state is None:
+            state = self.table
+        if move.num == 1:
+            state.move(move.source, move.dest)
+        else:
+            state.move_sequence(int(move.source[1:]), int(move.dest[1:]), move.num)
+
+    def undo_move(self, move, state=None):
+        """
+        Reverse apply_move().
+        :param MoveEvent move: Move
+        :param Tableau state: Position, the current table by default
+        """
+        if state is None:
+            state = self.table
+        if move.num == 1:
+            state.unmove(move.source, move.dest)
+        else:
+            state.move_sequence(int(move.dest[1:]), int(move.source[1:]), move.num)
+
+    def contiguous_range(self, column, state=None):
+        """
+        :param int column: Column
+        :param Tableau state: Position, the current table by default
+        :rtype: list[Card]
+        """
+        if state is None:
+            state = self.table
         chain_size = 0
         lower_card = None
 
         # verify range is valid, otherwise use largest stack size
-        for card in list(reversed(self.table.columns[column])):
+        cards = state.column(column)
+        for card in reversed(cards):
             if lower_card is not None:
                 if not card.can_stack(lower_card):
                     break
             lower_card = card
             chain_size += 1
 
-        return list(reversed(self.table.columns[column]))[:chain_size]
+        return list(reversed(cards))[:chain_size]
 
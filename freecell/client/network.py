@@ -1,10 +1,9 @@
-import asynchat
 import asyncore
-import json
 import socket
 import time
 import traceback
 
+from ..shared.protocol import MessageChannel, CLIENT, FRAMINGS
 from ..shared.version import VERSION
 
 from events import *
@@ -14,13 +13,24 @@ from events import *
 # must set source="networking" attribute
 import events
 
-
-class FreeCellNetworking(asynchat.async_chat):
-    def __init__(self, host="knitwithlogic.com", port=11982):
-        asynchat.async_chat.__init__(self)
-        self.event_dispatch = events.event_dispatch
-        self.set_terminator("\r\n")
-        self.buffer = []
+# Events sent to the server, and their message names
+SENT_EVENTS = {"Stats": "stats", "LoginEvent": "login", "RegisterEvent": "register", "TokenHashEvent": "tokenhash",
+               "SeedRequestEvent": "seedrequest", "JoinRoomEvent": "joinroom", "AuthRequestEvent": "auth"}
+
+class FreeCellNetworking(MessageChannel):
+    sender = CLIENT
+    event_types = vars(events)
+
+    def __init__(self, host="knitwithlogic.com", port=11982, framings=FRAMINGS, event_dispatch=None):
+        """
+        :param str host: Host
+        :param int port: Port
+        :param tuple[str] framings: Framings to offer the server, see protocol.FRAMINGS
+        :param EventDispatch event_dispatch: Dispatch for this connection's events, the client's by default
+        """
+        MessageChannel.__init__(self)
+        self.event_dispatch = event_dispatch if event_dispatch is not None else events.event_dispatch
+        self.framings = framings
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.addr = (host, port)
         self.connect(self.addr)
@@ -29,7 +39,7 @@ class FreeCellNetworking(asynchat.async_chat):
 
     def run(self, shutdown_event):
         shutdown_event.wait()
-        self.event_dispatch.register(self.send_event, ["Stats", "LoginEvent", "RegisterEvent", "TokenHashEvent", "SeedRequestEvent"])
+        self.event_dispatch.register(self.send_event, SENT_EVENTS.keys())
         while shutdown_event.is_set():
             MAX_FPS = 30
             S_PER_FRAME = 1.0/MAX_FPS
@@ -41,25 +51,13 @@ class FreeCellNetworking(asynchat.async_chat):
             elapsed = time.time()-start
             if elapsed < S_PER_FRAME:
                 time.sleep(S_PER_FRAME-elapsed)
-        self.event_dispatch.unregister(self.send_event, ["Stats", "LoginEvent", "RegisterEvent", "TokenHashEvent", "SeedRequestEvent"])
+        self.event_dispatch.unregister(self.send_event, SENT_EVENTS.keys())
         self.close_when_done()
 
-    def collect_incoming_data(self, data):
-        self.buffer.append(data)
-
-    def found_terminator(self):
-        message = json.loads("".join(self.buffer))
-        if "event" in message:
-            self.create_event(message)
-        else:
-            print "Non-event message received"
-
-        self.buffer = []
-
     def handle_connect(self):
         self.state = "connected"
         self.event_dispatch.send(MessageEvent(level="networking", message="Connected"))
-        self.send_json({"event":"connect", "version": VERSION})
+        self.send_message("connect", version=VERSION, framing=list(self.framings))
 
     def handle_error(self):
         traceback.print_exc()
@@ -67,44 +65,34 @@ class FreeCellNetworking(asynchat.async_chat):
         self.state = "refused"
         self.close()
 
-    def create_event(self, message):
-        if "event" in message:
-            if message["event"] == "seed":
-                self.event_dispatch.send(SeedEvent(seed=message["seed"]))
-            elif message["event"] == "stats":
-                if message["won"]:
-                    self.event_dispatch.send(MessageEvent(level="", message="Player %s has WON after %d seconds, %d moves, %d undos." % (message["id"], message["time"], message["moves"], message["undos"])))
-                else:
-                    self.event_dispatch.send(MessageEvent(level="", message="Player %s has conceded after %d seconds, %d moves, %d undos." % (message["id"], message["time"], message["moves"], message["undos"])))
-            elif message["event"] == "badversion":
-                self.event_dispatch.send(QuitEvent(message="Client version %s required" % message["min_version"]))
-            elif message["event"] == "nonce":
-                self.event_dispatch.send(NonceEvent(nonce=message["nonce"], salt=message["salt"]))
-            elif message["event"] == "unknownuser":
-                self.event_dispatch.send(UnknownUserEvent(username=message["username"]))
-            elif message["event"] == "nametaken":
-                self.event_dispatch.send(NameTakenEvent(username=message["username"]))
-            elif message["event"] == "logintoken":
-                self.event_dispatch.send(LoginTokenEvent(username=message["username"], token=message["token"]))
-            elif message["event"] == "loggedin":
-                self.event_dispatch.send(LoggedInEvent(username=message["username"]))
-            elif message["event"] == "loginfailed":
-                self.event_dispatch.send(LoginFailedEvent(username=message["username"]))
+    def handle_message(self, message, values):
+        if message.event is not None:
+            MessageChannel.handle_message(self, message, values)
+        elif message.name == "welcome":
+            if values["framing"] in self.framings:
+                self.framing = values["framing"]
+            if values["nonce"] is not None:
+                self.event_dispatch.send(ChallengeEvent(nonce=values["nonce"]))
+        elif message.name == "stats":
+            if values["won"]:
+                self.event_dispatch.send(MessageEvent(level="", message="Player %s has WON after %d seconds, %d moves, %d undos." % (values["id"], values["time"], values["moves"], values["undos"])))
+            else:
+                self.event_dispatch.send(MessageEvent(level="", message="Player %s has conceded after %d seconds, %d moves, %d undos." % (values["id"], values["time"], values["moves"], values["undos"])))
+        elif message.name == "verified":
+            if values["valid"]:
+                self.event_dispatch.send(MessageEvent(level="", message="Player %s's game was verified." % values["id"]))
+            else:
+                self.event_dispatch.send(MessageEvent(level="", message="Player %s's game was rejected: %s" % (values["id"], values["reason"])))
+        elif message.name == "badversion":
+            self.event_dispatch.send(QuitEvent(message="Client version %s required" % values["min_version"]))
 
     def send_event(self, event):
         with self.lock:
-            #"LoginEvent", "RegisterEvent", "TokenHashEvent"
-            if isinstance(event, Stats):
-                self.send_json({'event':'stats', 'seed':event.seed, 'time':event.time, 'moves':event.moves, 'undos':event.undos, 'won':event.won})
-            elif isinstance(event, LoginEvent):
-                self.send_json({'event':'login', 'username':event.username})
-            elif isinstance(event, RegisterEvent):
-                self.send_json({'event':'register', 'username':event.username})
-            elif isinstance(event, TokenHashEvent):
-                self.send_json({'event':'tokenhash', 'username':event.username, 'nonce_hash':event.nonce_hash})
-            elif isinstance(event, SeedRequestEvent):
-                self.send_json({'event':'seedrequest'})
+            self.send_message(SENT_EVENTS[type(event).__name__], **event._asdict())
 
-    def send_json(self, obj):
+    def send_message(self, name, **values):
+        """
+        :param str name: Message name, see protocol.MESSAGES
+        """
         if self.state == "connected":
-            self.push(json.dumps(obj)+"\r\n")
+            self.push(self.encode_message(name, values))
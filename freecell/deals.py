@@ -0,0 +1,59 @@
+# Bulk deal generation for offline seed analysis. Needs NumPy, which the
+# game itself does not.
+import numpy
+
+from .client.board import Tableau, NUM_CARDS
+
+def deal_seeds(seeds):
+    """
+    Deal many seeds at once. Runs the same Microsoft LCG as Deck.shuffle,
+    vectorised across seeds instead of looping per seed.
+    :param numpy.ndarray seeds: Seeds, any integer dtype
+    :return: uint8 array of shape (N, 52) with the card codes in deal
+             order: card i lands in column i % 8, row i // 8
+    :rtype: numpy.ndarray
+    """
+    state = numpy.asarray(seeds, dtype=numpy.uint64).ravel() & numpy.uint64(0xffffffff)
+    count = len(state)
+    rows = numpy.arange(count)
+
+    deck_nums = numpy.tile(numpy.arange(NUM_CARDS, dtype=numpy.uint8), (count, 1))
+    deals = numpy.empty((count, NUM_CARDS), dtype=numpy.uint8)
+
+    multiplier = numpy.uint64(214013)
+    increment = numpy.uint64(2531011)
+    mask = numpy.uint64(0xffffffff)
+    for card in range(NUM_CARDS):
+        cardsleft = NUM_CARDS - card
+        state = (state * multiplier + increment) & mask
+        c = ((state >> numpy.uint64(16)) & numpy.uint64(0x7fff)) % numpy.uint64(cardsleft)
+        c = c.astype(numpy.intp)
+
+        deals[:, card] = deck_nums[rows, c]
+        # Same swap-with-last trick as Deck.shuffle
+        deck_nums[rows, c] = deck_nums[:, cardsleft - 1]
+
+    return deals
+
+def iter_deals(seeds, chunk_size=65536):
+    """
+    Deal seeds in chunks to bound memory on very large scans.
+    :param numpy.ndarray seeds: Seeds
+    :param int chunk_size: Seeds per chunk
+    :return: (seeds, deals) per chunk
+    :rtype: collections.Iterable[(numpy.ndarray, numpy.ndarray)]
+    """
+    seeds = numpy.asarray(seeds).ravel()
+    for start in range(0, len(seeds), chunk_size):
+        chunk = seeds[start:start + chunk_size]
+        yield chunk, deal_seeds(chunk)
+
+def tableau_from_deal(deal):
+    """
+    :param numpy.ndarray deal: One row of deal_seeds()
+    :rtype: Tableau
+    """
+    table = Tableau()
+    for i, code in enumerate(deal):
+        table.push_column(i % 8, int(code))
+    return table
@@ -1,12 +1,15 @@
-import json
+import multiprocessing
 import threading
 import time
 import random
+import string
 
 import events
-from loginserver import LoginWrapper
+from loginserver import LoginWrapper, user_store
 from network import FreecellServer
+from replay import verify_game
 
+from ..shared.protocol import FRAMINGS, JSON
 from ..shared.version import VERSION
 
 class Competitor(object):
@@ -15,70 +18,241 @@ class Competitor(object):
         :param network.FreecellConnection connection: Connection
         """
         self.connection = connection
+        self.room = None
+        """:type : Room | None"""
 
-    def send(self, event):
-        self.connection.send_json(event)
+    def send(self, name, **values):
+        """
+        :param str name: Message name, see protocol.MESSAGES
+        """
+        self.connection.send_message(name, **values)
+
+class Room(object):
+    """
+    One competition: a seed everyone in the room plays, and its roster.
+    The seed changes after a verified win of it. A room is created by its
+    first member and closed when its last member leaves, except the default
+    room every competitor starts in.
+    """
+    def __init__(self, room_id):
+        """
+        :param str room_id: Room name
+        """
+        self.id = room_id
+        self.seed = random.randint(1, 0xFFFFFFFF)
+        self.competitors = {}
+        """:type : dict[str, Competitor]"""
+        self.created = time.time()
+        """:type : float (time.time() it was opened)"""
+        self.rounds = 0
+        """:type : int (seeds won so far)"""
+
+    def next_seed(self):
+        self.seed = random.randint(1, 0xFFFFFFFF)
+        self.rounds += 1
 
-# last until everyone finishes seed or quits
 class CompetitionServer(object):
-    def __init__(self, host, port):
+    DEFAULT_ROOM = "main"
+    MAX_ROOM_NAME = 32
+    # As the client allows in usernames
+    ROOM_NAME_CHARACTERS = frozenset(string.ascii_letters + string.digits + "-_")
+    # From connect to a successful login
+    LOGIN_TIMEOUT = 60.0
+
+    def __init__(self, host, port, verify_processes=None, max_connections=FreecellServer.MAX_CONNECTIONS,
+                 metrics_port=None):
+        """
+        :param str host: Host
+        :param int port: Port
+        :param int verify_processes: Replay verification workers, defaults to the CPU count
+        :param int max_connections: Connections served at once
+        :param int metrics_port: Serve metrics on this local port, None for no metrics endpoint
+        """
         self.event_dispatch = events.event_dispatch
         self.competitors = {}
+        """:type : dict[str, Competitor] (every logged in competitor, each is in a room)"""
+        self.rooms = {}
+        """:type : dict[str, Room]"""
         self.logins = {}
         self.shutdown_event = threading.Event()
-        self.networking = FreecellServer(host, port)
-        threading.Thread(target=self.networking.run, args=(self.shutdown_event,)).start()
-        self.current_seed = random.randint(1, 0xFFFFFFFF)
+        # Fork the workers before any threads are started
+        self.verify_pool = multiprocessing.Pool(verify_processes)
+        self.networking = FreecellServer(host, port, max_connections)
+        metrics = self.networking.metrics
+        metrics.gauge("freecell_connections_by_state", "Open connections by how far they got",
+                      self.connection_states, label="state")
+        metrics.gauge("freecell_rooms", "Open rooms", lambda: len(self.rooms))
+        metrics.gauge("freecell_room_age_seconds", "Seconds since each open room was opened",
+                      self.room_ages, label="room")
+        self.logins_done = metrics.counter("freecell_logins_total", "Successful logins")
+        self.quits = metrics.counter("freecell_disconnects_total", "Connections closed, by reason", label="reason")
+        if metrics_port is not None:
+            self.networking.serve_metrics(metrics_port)
 
     def start(self):
         self.event_dispatch.register(self.competitor_join, ["JoinEvent"])
         self.event_dispatch.register(self.competitor_auth, ["AuthEvent"])
         self.event_dispatch.register(self.competitor_quit, ["QuitEvent"])
         self.event_dispatch.register(self.competitor_win, ["WinEvent"])
+        self.event_dispatch.register(self.competitor_verified, ["VerifiedEvent"])
+        self.event_dispatch.register(self.competitor_join_room, ["JoinRoomEvent"])
         self.event_dispatch.register(self.send_seed, ["SeedRequestEvent"])
-        MAX_FPS = 30
-        S_PER_FRAME = 1.0/MAX_FPS
         self.shutdown_event.set()
-        while self.shutdown_event.is_set():
-            start = time.time()
-            try:
-                self.event_dispatch.update(S_PER_FRAME)
-                elapsed = time.time() - start
-                if elapsed < S_PER_FRAME:
-                    time.sleep(S_PER_FRAME-elapsed)
-            except KeyboardInterrupt:
-                print "Keyboard Interrupt"
-                self.shutdown_event.clear()
+        try:
+            self.networking.run(self.shutdown_event)
+        except KeyboardInterrupt:
+            print "Keyboard Interrupt"
+            self.shutdown_event.clear()
+        user_store.close()
+        self.verify_pool.terminate()
+
+    def connection_states(self):
+        """
+        Read off the open connections, a login or competitor whose QuitEvent
+        is still queued is not counted.
+        :return: Connections waiting for connect, logging in, and logged in
+        :rtype: dict[str, int]
+        """
+        states = {"handshake": 0, "login": 0, "playing": 0}
+        for connection in self.networking.connections.itervalues():
+            if connection.id in self.competitors:
+                states["playing"] += 1
+            elif connection.id in self.logins:
+                states["login"] += 1
+            else:
+                states["handshake"] += 1
+        return states
+
+    def room_ages(self):
+        """
+        :rtype: dict[str, float]
+        """
+        now = time.time()
+        return dict((room.id, now - room.created) for room in self.rooms.itervalues())
+
+    def enter_room(self, competitor_id, room_id):
+        """
+        Move a competitor to a room, creating it if needed, and tell them.
+        :param str competitor_id: Competitor id
+        :param str room_id: Room name
+        """
+        competitor = self.competitors[competitor_id]
+        room = competitor.room
+        # Leaving first would close a room its only member is joining again
+        if room is None or room.id != room_id:
+            self.leave_room(competitor_id)
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = self.rooms[room_id] = Room(room_id)
+                print "ROOM OPENED: %s" % room_id
+            room.competitors[competitor_id] = competitor
+            competitor.room = room
+        competitor.send("joinedroom", room=room.id, players=sorted(room.competitors))
+
+    def leave_room(self, competitor_id):
+        """
+        :param str competitor_id: Competitor id
+        """
+        competitor = self.competitors[competitor_id]
+        room = competitor.room
+        if room is None:
+            return
+        del room.competitors[competitor_id]
+        competitor.room = None
+        if len(room.competitors) == 0 and room.id != self.DEFAULT_ROOM:
+            del self.rooms[room.id]
+            print "ROOM CLOSED: %s after %d rounds" % (room.id, room.rounds)
+
+    def competitor_join_room(self, event):
+        if event.id not in self.competitors:
+            return
+        room_id = event.room.strip()
+        if not room_id or len(room_id) > self.MAX_ROOM_NAME \
+                or not all(character in self.ROOM_NAME_CHARACTERS for character in room_id):
+            room_id = self.DEFAULT_ROOM
+        room_id = str(room_id)
+        print "JOIN ROOM: %s %s" % (event.id, room_id)
+        self.enter_room(event.id, room_id)
 
     def competitor_win(self, event):
         print "WIN: %s" % event.id
-        if event.won:
-            self.current_seed = random.randint(1, 0xFFFFFFFF)
-        for competitor in self.competitors.values():
-            #WinEvent = namedtuple('WinEvent', ['id', 'seed', 'time', 'moves', 'undos', 'won'])
-            competitor.send({"event":"stats", "id":event.id, "seed":event.seed, "time":event.time, "moves":event.moves, "undos":event.undos, "won":event.won})
+        competitor = self.competitors.get(event.id)
+        if competitor is None:
+            return
+        competitor.connection.in_game = False
+        room = competitor.room
+        self.broadcast(room, "stats", id=event.id, seed=event.seed, time=event.time, moves=event.moves, undos=event.undos, won=event.won)
+
+        # Replay the game off the loop, the result comes back as a VerifiedEvent from the pool's thread
+        def verified(result):
+            valid, reason = result
+            self.event_dispatch.send(events.make_event('VerifiedEvent', id=event.id, room=room.id, seed=event.seed, won=event.won, valid=valid, reason=reason))
+            self.networking.wake()
+        self.verify_pool.apply_async(verify_game, (event.seed, event.log, event.moves, event.undos, event.won), callback=verified)
+
+    def competitor_verified(self, event):
+        print "VERIFIED: %s %s %s" % (event.id, event.valid, event.reason)
+        room = self.rooms.get(event.room)
+        if room is None:
+            return
+        if event.valid and event.won and event.seed == room.seed:
+            room.next_seed()
+        self.broadcast(room, "verified", id=event.id, seed=event.seed, valid=event.valid, reason=event.reason)
+
+    def broadcast(self, room, name, **values):
+        """
+        :param Room room: Room to send to
+        :param str name: Message name, see protocol.MESSAGES
+        """
+        self.networking.broadcast([competitor.connection for competitor in room.competitors.values()], name, **values)
 
     def competitor_join(self, event):
 
         print "JOIN: %s v%.2f" % (event.id, event.version)
 
+        # connect is only answered once, repeating it must not restart the login timeout
+        if event.id in self.logins or event.id in self.competitors:
+            return
+
         if event.version == VERSION:
-            self.logins[event.id] = LoginWrapper(event.object)
+            # Older clients offer no framing and get no welcome, they stay on JSON
+            # and log in with login and tokenhash
+            login = self.logins[event.id] = LoginWrapper(event.object, tickets=bool(event.framing))
+            event.object.expect(self.LOGIN_TIMEOUT, "Login timed out")
+            if event.framing:
+                framing = next((framing for framing in FRAMINGS if framing in event.framing), JSON)
+                event.object.send_message("welcome", version=VERSION, framing=framing, nonce=login.nonce)
+                event.object.framing = framing
         else:
-            event.object.send_json({"event":"badversion", "min_version":VERSION})
+            event.object.send_message("badversion", min_version=VERSION)
 
     def competitor_auth(self, event):
         print "AUTH"
+        # A QuitEvent dispatched ahead of this one has already dropped the login
+        login = self.logins.pop(event.id, None)
+        if login is None:
+            return
+        login.close()
+        if event.connection.state == "disconnected":
+            return
+        self.logins_done.value += 1
+        event.connection.expect(None)
         competitor = Competitor(event.connection)
         self.competitors[event.id] = competitor
-        del self.logins[event.id]
+        self.enter_room(event.id, self.DEFAULT_ROOM)
 
     def send_seed(self, event):
         print "SEND SEED"
         if event.id in self.competitors:
-            self.competitors[event.id].send({"event":"seed", "seed":self.current_seed})
+            competitor = self.competitors[event.id]
+            competitor.connection.in_game = True
+            competitor.send("seed", seed=competitor.room.seed)
 
     def competitor_quit(self, event):
         print "QUIT: %s %s" % (event.id, event.reason)
+        self.quits.inc(event.reason)
+        if event.id in self.logins:
+            self.logins.pop(event.id).close()
         if event.id in self.competitors:
+            self.leave_room(event.id)
             del self.competitors[event.id]
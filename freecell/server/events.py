@@ -1,22 +1,22 @@
 import json
 import keyword
-import Queue
-import threading
-import time
 
-from collections import defaultdict
+from ..shared.dispatch import EventDispatch
 
 event_prototypes = [
-    {'event':'JoinEvent', 'version':float, 'object':None},
+    {'event':'JoinEvent', 'version':float, 'framing':list, 'object':None},
     {'event':'AuthEvent', 'connection':None},
-    {'event':'WinEvent', 'seed':int, 'time':float, 'moves':int, 'undos':int, 'won':bool},
+    {'event':'WinEvent', 'seed':int, 'time':float, 'moves':int, 'undos':int, 'won':bool, 'log':list},
+    {'event':'VerifiedEvent', 'room':basestring, 'seed':int, 'won':bool, 'valid':bool, 'reason':basestring},
     {'event':'QuitEvent', 'reason':basestring},
+    {'event':'JoinRoomEvent', 'room':basestring},
 
     {'event':'LoginEvent', 'username':basestring},
     {'event':'RegisterEvent', 'username':basestring},
     {'event':'NameTakenEvent', 'username':basestring},
     {'event':'LoginTokenEvent', 'username':basestring, 'token':basestring},
     {'event':'TokenHashEvent', 'username':basestring, 'nonce_hash':basestring},
+    {'event':'AuthRequestEvent', 'username':basestring, 'nonce_hash':basestring, 'ticket':basestring},
 
     {'event':'SeedRequestEvent'},
     ]
@@ -24,38 +24,51 @@ event_prototypes = [
 events = {}
 """:type : dict[str, Event] """
 
-# Change event to event_type
 class Event(object):
+    """
+    Base of the generated event classes, see server_event_creator.
+    """
+    __slots__ = ()
     prototype = {}
     event = None
-    def __init__(self, **kwargs):
-        if "event" in kwargs:
-            if self.event != kwargs["event"]:
-                raise TypeError("Unable to create '%s' object from '%s' data" % (self.event, kwargs["event"]))
-            del kwargs["event"]
 
-        if not sorted(kwargs.keys()) == sorted(self.prototype.keys()):
-            raise TypeError('Required args: %s, Provided args: %s' %
-                            (", ".join(self.prototype.keys()), ", ".join(kwargs.keys()))
-                            )
+    def serialize(self):
+        ser_dict = {key: getattr(self, key) for key in self.prototype}
+        ser_dict["event"] = self.event
+        return json.dumps(ser_dict)
 
-        for key, arg_type in self.prototype.items():
-            if arg_type is not None:
-                if not isinstance(kwargs[key], arg_type):
-                    raise TypeError("Arg '%s' must be of type %s" % (key, arg_type.__name__))
+# Compiled once per prototype by server_event_creator, like collections.namedtuple
+event_template = """\
+class {event}(Event):
+    __slots__ = {slots!r}
+    prototype = prototype
+    event = {event!r}
 
-        self.__dict__.update(kwargs)
+    def __init__(self, {args}, event={event!r}):
+        if event != {event!r}:
+            raise TypeError("Unable to create '{event}' object from '%s' data" % event)
+{checks}
+{assignments}
 
     def serialize(self):
-        ser_dict = {key: self.__dict__[key] for key in self.prototype.keys()}
-        ser_dict["event"] = self.event
-        return json.dumps(ser_dict)
+        return dumps({{'event': {event!r}, {items}}})
+"""
+
+check_template = """\
+        if not isinstance({key}, {key}_type):
+            raise TypeError("Arg '{key}' must be of type {type_name}")"""
 
 def server_event_creator(event_prototype):
+    """
+    Generate an event class with __slots__ and a constructor and serializer
+    specialised for the prototype. Missing or unknown args raise TypeError
+    from the call itself, type checks are unrolled into the constructor.
+    :param dict event_prototype: Arg name to type (None for any), plus "event"
+    """
     assert "event" in event_prototype
     for attr in event_prototype:
         assert not keyword.iskeyword(attr)
-        assert attr not in ["prototype", "id", "origin"]
+        assert attr not in ["prototype", "id", "origin", "self", "dumps", "isinstance", "Event"]
 
     event_type = event_prototype["event"]
     assert event_type not in events
@@ -64,65 +77,32 @@ def server_event_creator(event_prototype):
     #event_prototype.update({"id":str, "origin":str})
     event_prototype.update({"id":str})
     del event_prototype["event"] # remove "event" from the prototype, the class already knows what type it is
-    class_dict = {"prototype": event_prototype, "event":event_type}
-    class_dict.update(event_prototype)
 
-    Cls = type(event_type, (Event,), class_dict)
-
-    events[event_type] = Cls
+    keys = sorted(event_prototype)
+    namespace = {"Event": Event, "prototype": event_prototype, "dumps": json.dumps}
+    checks = []
+    for key in keys:
+        arg_type = event_prototype[key]
+        if arg_type is not None:
+            namespace[key + "_type"] = arg_type
+            checks.append(check_template.format(key=key, type_name=arg_type.__name__))
+
+    source = event_template.format(
+        event=event_type,
+        slots=tuple(keys),
+        args=", ".join(keys),
+        checks="\n".join(checks),
+        assignments="\n".join("        self.%s = %s" % (key, key) for key in keys),
+        items=", ".join("%r: self.%s" % (key, key) for key in keys),
+    )
+    exec source in namespace
+
+    events[event_type] = namespace[event_type]
 
 def make_event(event_type, **kwargs):
     Cls = events[event_type]
     return Cls(**kwargs)
 
-class EventDispatch(object):
-    def __init__(self):
-        self.queue = Queue.PriorityQueue()
-        self.registered = defaultdict(list)
-        """:type : defaultdict[str, list]"""
-        self.lock = threading.Lock()
-
-    def register(self, callback, event_types):
-        """
-        :param callable callback: Callback for event types
-        :param list[str] event_types: List of event types (as strings)
-        """
-        with self.lock:
-            for event_type in event_types:
-                if callback not in self.registered[event_type]:
-                    self.registered[event_type].append(callback)
-
-    def unregister(self, callback, event_types):
-        """
-        :param callable callback: Callback for event types
-        :param list[str] event_types: List of event types (as strings)
-        :rtype bool:
-        """
-        with self.lock:
-            for event_type in event_types:
-                if callback in self.registered[event_type]:
-                    self.registered[event_type].remove(callback)
-
-    def send(self, event, priority=5):
-        """
-        :param namedtuple event: Event
-        """
-        self.queue.put((priority, time.time(), event))
-
-    def update(self, max_time):
-        start = time.time()
-        while not self.queue.empty():
-            item = self.queue.get_nowait()
-            event = item[2]
-            for callback in self.registered[type(event).__name__]:
-                callback(event)
-            self.queue.task_done()
-
-            if time.time() - start >= max_time:
-                return False
-        else:
-            return True
-
 for event in event_prototypes:
     server_event_creator(event)
 
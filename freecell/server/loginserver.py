@@ -1,61 +1,145 @@
 import hashlib
-import os.path
-import pickle
+import hmac
+import os
 import random
 import string
+import time
 
 import events
+from userstore import UserStore
 
-if os.path.isfile(os.path.expanduser("~/.freecell_logins")):
-    with open(os.path.expanduser("~/.freecell_logins")) as db_file:
-        USER_DATABASE = pickle.load(db_file)
-else:
-    USER_DATABASE = {}
+user_store = UserStore()
 
-def save_database():
-    with open(os.path.expanduser("~/.freecell_logins"), "w") as db_file:
-        pickle.dump(USER_DATABASE, db_file)
+# Resumption tickets are signed with a key that only lives as long as the
+# process, so a restart invalidates them all
+TICKET_LIFETIME = 600
+ticket_key = os.urandom(32)
+
+def to_bytes(value):
+    """
+    :param str | unicode value: Field from a message
+    :rtype: str
+    """
+    return value.encode("utf-8") if isinstance(value, unicode) else str(value)
+
+def make_ticket(username, now):
+    """
+    :param str username: Username the ticket logs in as
+    :param float now: Current time
+    :return: "username|expires|signature", and the expiry time
+    :rtype: (str, int)
+    """
+    expires = int(now) + TICKET_LIFETIME
+    body = "%s|%d" % (to_bytes(username), expires)
+    return "%s|%s" % (body, hmac.new(ticket_key, body, hashlib.sha256).hexdigest()), expires
+
+def check_ticket(ticket, username, now):
+    """
+    :param str ticket: Ticket from make_ticket
+    :param str username: Username logging in
+    :param float now: Current time
+    :return: False if the ticket is forged, malformed, expired or for someone else
+    :rtype: bool
+    """
+    parts = to_bytes(ticket).rsplit("|", 2)
+    if len(parts) != 3 or not parts[1].isdigit() or parts[0] != to_bytes(username):
+        return False
+    expected = hmac.new(ticket_key, "%s|%s" % (parts[0], parts[1]), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, parts[2]) and int(parts[1]) >= now
 
 class LoginWrapper(object):
-    def __init__(self, connection):
+    """
+    Login handshake for one connection. Its handlers are scoped to the
+    connection id, so the dispatcher only hands it that connection's events.
+
+    Older clients send login, get the nonce and answer with tokenhash. Newer
+    clients get the nonce in welcome and send auth with the hash straight
+    away, or with a ticket from an earlier login, which needs no hash.
+    """
+    def __init__(self, connection, tickets=False):
+        """
+        :param FreecellConnection connection: Connection
+        :param bool tickets: Send a ticket on login, only clients that got a welcome know the message
+        """
         self.connection = connection
+        self.tickets = tickets
         self.event_dispatch = events.event_dispatch
         self.nonce = random.randint(0, 0xFFFFFFFF)
 
-        self.event_dispatch.register(self.login, ["LoginEvent"])
-        self.event_dispatch.register(self.register, ["RegisterEvent"])
+        self.event_dispatch.register(self.login, ["LoginEvent"], scope=connection.id)
+        self.event_dispatch.register(self.register, ["RegisterEvent"], scope=connection.id)
+        self.event_dispatch.register(self.auth, ["AuthRequestEvent"], scope=connection.id)
+
+    def close(self):
+        """
+        Drop the handlers once the connection has logged in or gone.
+        """
+        self.event_dispatch.unregister(self.login, ["LoginEvent"], scope=self.connection.id)
+        self.event_dispatch.unregister(self.register, ["RegisterEvent"], scope=self.connection.id)
+        self.event_dispatch.unregister(self.response, ["TokenHashEvent"], scope=self.connection.id)
+        self.event_dispatch.unregister(self.auth, ["AuthRequestEvent"], scope=self.connection.id)
+
+    def check_hash(self, user, nonce_hash):
+        """
+        :param UserRecord user: User
+        :param str nonce_hash: sha256 of the user's token hash and this connection's nonce
+        :rtype: bool
+        """
+        return hmac.compare_digest(hashlib.sha256(user.token_hash+str(self.nonce)).hexdigest(), to_bytes(nonce_hash))
+
+    def logged_in(self, username):
+        # Closed first, so a second attempt already queued cannot log in twice
+        self.close()
+        # Ticket before loggedin, while the client is still on its login screen
+        if self.tickets:
+            ticket, expires = make_ticket(username, time.time())
+            self.connection.send_message("ticket", username=username, ticket=ticket, expires=expires)
+        self.connection.send_message("loggedin", username=username)
+        self.event_dispatch.send(events.make_event('AuthEvent', id=self.connection.id, connection=self.connection))
 
     # RegisterEvent(username)
     def register(self, event):
-        if event.id == self.connection.id:
-            if event.username in USER_DATABASE:
-                self.connection.send_json({"event":"nametaken", "username":event.username})
-            else:
-                salt = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for x in range(16))
-                token = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for x in range(16))
-                USER_DATABASE[event.username] = (hashlib.sha256(token+salt).hexdigest(), salt)
-                save_database()
-                self.connection.send_json({"event":"logintoken", "username":event.username, "token": token})
+        if event.username in user_store:
+            self.connection.send_message("nametaken", username=event.username)
+        else:
+            salt = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for x in range(16))
+            token = ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for x in range(16))
+            user_store.add(event.username, hashlib.sha256(token+salt).hexdigest(), salt)
+            self.connection.send_message("logintoken", username=event.username, token=token)
 
     # LoginEvent(username)
     def login(self, event):
-        if event.id == self.connection.id:
-            if event.username in USER_DATABASE:
-                self.connection.send_json({"event":"nonce", "nonce":self.nonce, "salt":USER_DATABASE[event.username][1]})
-                self.event_dispatch.register(self.response, ["TokenHashEvent"])
-            else:
-                self.connection.send_json({"event":"unknownuser", "username":event.username})
+        user = user_store.get(event.username)
+        if user is not None:
+            self.connection.send_message("nonce", nonce=self.nonce, salt=user.salt)
+            self.event_dispatch.register(self.response, ["TokenHashEvent"], scope=self.connection.id)
+        else:
+            self.connection.send_message("unknownuser", username=event.username)
 
     # TokenHashEvent(username, nonce_hash)
     def response(self, event):
-        if event.id == self.connection.id and event.username in USER_DATABASE:
-            nonce_hash = hashlib.sha256(USER_DATABASE[event.username][0]+str(self.nonce)).hexdigest()
-            if nonce_hash == event.nonce_hash:
-                self.connection.send_json({"event":"loggedin", "username":event.username})
-                self.event_dispatch.send(events.make_event('AuthEvent', id=self.connection.id, connection=self.connection))
+        user = user_store.get(event.username)
+        if user is not None:
+            self.event_dispatch.unregister(self.response, ["TokenHashEvent"], scope=self.connection.id)
+            if self.check_hash(user, event.nonce_hash):
+                self.logged_in(event.username)
             else:
-                self.connection.send_json({"event":"loginfailed", "username":event.username})
-            self.event_dispatch.unregister(self.response, ["TokenHashEvent"])
+                self.connection.send_message("loginfailed", username=event.username)
+
+    # AuthRequestEvent(username, nonce_hash, ticket)
+    def auth(self, event):
+        if event.ticket and check_ticket(event.ticket, event.username, time.time()):
+            self.logged_in(event.username)
+            return
+        user = user_store.get(event.username)
+        if user is None:
+            self.connection.send_message("unknownuser", username=event.username)
+        elif event.nonce_hash and self.check_hash(user, event.nonce_hash):
+            self.logged_in(event.username)
+        else:
+            self.connection.send_message("loginfailed", username=event.username)
+        # One try, after that it is login and tokenhash
+        self.event_dispatch.unregister(self.auth, ["AuthRequestEvent"], scope=self.connection.id)
 
 class LoginServer(object):
     def __init__(self):
@@ -0,0 +1,180 @@
+import asynchat
+import asyncore
+import socket
+
+from ..shared.instrument import Histogram
+
+class Counter(object):
+    """
+    Counts up. Unlabelled counters can also just add to value.
+    """
+    __slots__ = ("value", "values")
+
+    def __init__(self):
+        self.value = 0
+        self.values = {}
+        """:type : dict[str, int] (by label value, for labelled counters)"""
+
+    def inc(self, label=None, amount=1):
+        """
+        :param str label: Label value, None for an unlabelled counter
+        :param int amount: Amount
+        """
+        if label is None:
+            self.value += amount
+        else:
+            self.values[label] = self.values.get(label, 0) + amount
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and histograms, rendered in the Prometheus text format.
+    Gauges and read counters are functions called only by render(), so
+    anything that can be read off the server's own state costs nothing
+    until it is scraped. Only for the loop thread.
+    """
+    # Histogram buckets rendered, le="1" up to le="2**20", the same on every
+    # scrape. Past the last one a value only shows in le="+Inf"
+    HISTOGRAM_BUCKETS = 21
+
+    def __init__(self):
+        self.metrics = []
+        """:type : list[(str, str, str, str, callable)] (name, type, help, label name, read)"""
+
+    def add(self, name, kind, help, read, label=None):
+        """
+        :param str name: Metric name
+        :param str kind: "counter", "gauge" or "histogram"
+        :param str help: Description
+        :param callable read: Returns the value, or a dict of them by label value if label is set
+        :param str label: Label name
+        """
+        self.metrics.append((name, kind, help, label, read))
+
+    def counter(self, name, help, label=None, read=None):
+        """
+        :param callable read: Read the count from elsewhere instead of returning a Counter
+        :rtype: Counter | None
+        """
+        if read is not None:
+            self.add(name, "counter", help, read, label)
+            return None
+        counter = Counter()
+        self.add(name, "counter", help, (lambda: counter.values) if label else (lambda: counter.value), label)
+        return counter
+
+    def gauge(self, name, help, read, label=None):
+        self.add(name, "gauge", help, read, label)
+
+    def histogram(self, name, help):
+        """
+        :rtype: Histogram
+        """
+        histogram = Histogram()
+        self.add(name, "histogram", help, lambda: histogram)
+        return histogram
+
+    def render(self):
+        """
+        :rtype: str
+        """
+        lines = []
+        for name, kind, help, label, read in self.metrics:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            value = read()
+            if kind == "histogram":
+                lines.extend(self.render_histogram(name, value))
+            elif label is None:
+                lines.append("%s %s" % (name, format_value(value)))
+            else:
+                for label_value, count in sorted(value.items()):
+                    lines.append('%s{%s="%s"} %s' % (name, label, escape(label_value), format_value(count)))
+        return "\n".join(lines) + "\n"
+
+    def render_histogram(self, name, histogram):
+        """
+        :param Histogram histogram: Histogram
+        :rtype: list[str]
+        """
+        lines = []
+        seen = 0
+        for bucket in xrange(self.HISTOGRAM_BUCKETS):
+            seen += histogram.counts[bucket]
+            lines.append('%s_bucket{le="%d"} %d' % (name, 1 << bucket, seen))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, histogram.count))
+        lines.append("%s_sum %s" % (name, format_value(histogram.total)))
+        lines.append("%s_count %d" % (name, histogram.count))
+        return lines
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def escape(label_value):
+    return str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class MetricsRequest(asynchat.async_chat):
+    """
+    One HTTP request for the metrics. Whatever the request, the reply is
+    the rendered registry, then the connection is closed.
+    """
+    MAX_REQUEST = 8192
+    TIMEOUT = 5.0
+
+    def __init__(self, sock, registry, timers):
+        """
+        :param socket.socket sock: Socket
+        :param MetricsRegistry registry: Metrics to serve
+        :param TimerWheel timers: Wheel for the request timeout
+        """
+        asynchat.async_chat.__init__(self, sock=sock)
+        self.registry = registry
+        self.timers = timers
+        self.received = 0
+        self.set_terminator("\r\n\r\n")
+        self.timer = timers.schedule(self.TIMEOUT, self.close)
+
+    def collect_incoming_data(self, data):
+        self.received += len(data)
+        if self.received > self.MAX_REQUEST:
+            self.close()
+
+    def found_terminator(self):
+        self.set_terminator(None)
+        body = self.registry.render()
+        self.push("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s"
+                  % (len(body), body))
+        self.close_when_done()
+
+    def handle_error(self):
+        self.close()
+
+    def close(self):
+        self.timers.cancel(self.timer)
+        asynchat.async_chat.close(self)
+
+class MetricsListener(asyncore.dispatcher):
+    """
+    Plain text metrics over HTTP on the loop, for curl or Prometheus. The
+    registry is rendered when a request arrives, never otherwise.
+    """
+    def __init__(self, registry, timers, host, port):
+        """
+        :param MetricsRegistry registry: Metrics to serve
+        :param TimerWheel timers: Wheel for request timeouts
+        :param str host: Host, keep it local
+        :param int port: Port
+        """
+        asyncore.dispatcher.__init__(self)
+        self.registry = registry
+        self.timers = timers
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            MetricsRequest(pair[0], self.registry, self.timers)
@@ -1,30 +1,68 @@
-import asynchat
 import asyncore
-import json
+import errno
+import fcntl
+import os
 import random
 import socket
 import string
-import threading
 import time
 import traceback
 
 import events
+from metrics import MetricsListener, MetricsRegistry
+from timerwheel import TimerWheel
 
-class FreecellConnection(asynchat.async_chat):
-    def __init__(self, sock, addr, lock):
+from ..shared.protocol import MessageChannel, SERVER, encode
+
+class FreecellConnection(MessageChannel):
+    """
+    Outgoing frames are queued by reference, so a broadcast frame is shared
+    by every connection it goes to. queued counts the bytes not yet
+    written: above HIGH_WATERMARK the client is backlogged, and if it does
+    not drain below LOW_WATERMARK within SLOW_CONSUMER_TIMEOUT, or ever
+    reaches MAX_QUEUED, it is disconnected.
+
+    Timeouts are timers on the server's wheel. A connection that sends
+    nothing for MAX_IDLE to 2 * MAX_IDLE seconds is disconnected, unless
+    in_game is set, clients send nothing while a game is played. expect()
+    sets a deadline for the next step of the handshake. Closing
+    cancels them and calls on_close, which is how the server forgets it.
+    """
+    sender = SERVER
+    event_types = events.events
+
+    HIGH_WATERMARK = 256 * 1024
+    LOW_WATERMARK = 64 * 1024
+    MAX_QUEUED = 4 * 1024 * 1024
+    SLOW_CONSUMER_TIMEOUT = 10.0
+    MAX_IDLE = 1800.0
+
+    def __init__(self, sock, addr, timers, on_close=None):
         """
         :param socket.socket sock: Socket
         :param (str, int) addr: Address
-        :param threading.lock lock: Network lock
+        :param TimerWheel timers: Wheel for the connection's timeouts
+        :param callable on_close: Called with the connection once it is closed
         """
-        asynchat.async_chat.__init__(self, sock=sock)
-        self.set_terminator("\r\n")
+        MessageChannel.__init__(self, sock=sock)
         self.addr = addr
         self.event_dispatch = events.event_dispatch
         self.id = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(8))
-        self.buffer = []
         self.state = "connecting"
-        self.lock = lock
+        self.queued = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timers = timers
+        self.on_close = on_close
+        self.backlog_timer = None
+        """:type : timerwheel.Timer | None (running while queued is over HIGH_WATERMARK)"""
+        self.deadline = None
+        """:type : timerwheel.Timer | None"""
+        # Set by every message, checked and cleared when idle_timer fires
+        self.active = False
+        self.in_game = False
+        """:type : bool (set by the game server between a seed and the game's stats)"""
+        self.idle_timer = timers.schedule(self.MAX_IDLE, self.check_idle)
 
     def handle_connect(self):
         self.state = "connected"
@@ -33,88 +71,288 @@ class FreecellConnection(asynchat.async_chat):
         if self.state != "disconnected":
             self.event_dispatch.send(events.make_event('QuitEvent', id=self.id, reason="Client disconnected"))
             self.state = "disconnected"
+        # A hung up socket stays readable, left open it would keep the loop out of select
+        self.close()
 
     def handle_error(self):
         traceback.print_exc()
+        self.disconnect("Exception occurred")
 
+    def disconnect(self, reason):
+        """
+        :param str reason: Reason given in the QuitEvent
+        """
         if self.state != "disconnected":
-            self.event_dispatch.send(events.make_event('QuitEvent', id=self.id, reason="Exception occurred"))
+            self.event_dispatch.send(events.make_event('QuitEvent', id=self.id, reason=reason))
             self.state = "disconnected"
             self.close()
 
-    def collect_incoming_data(self, data):
-        self.buffer.append(data)
+    def close(self):
+        MessageChannel.close(self)
+        self.timers.cancel(self.idle_timer)
+        self.timers.cancel(self.deadline)
+        self.timers.cancel(self.backlog_timer)
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(self)
 
-    def found_terminator(self):
-        message = json.loads("".join(self.buffer))
-        self.buffer = []
+    def expect(self, timeout, reason="Timed out"):
+        """
+        Disconnect unless expect() is called again within timeout, replacing
+        any earlier deadline.
+        :param float | None timeout: Seconds, None only cancels the deadline
+        :param str reason: Reason given in the QuitEvent
+        """
+        self.timers.cancel(self.deadline)
+        self.deadline = None
+        if timeout is not None and self.state != "disconnected":
+            self.deadline = self.timers.schedule(timeout, self.disconnect, reason)
 
-        if "event" in message:
-            self.create_event(message)
+    def check_idle(self):
+        if self.active or self.in_game:
+            self.active = False
+            self.idle_timer = self.timers.schedule(self.MAX_IDLE, self.check_idle)
         else:
-            print "Non-event message received"
-
-    def create_event(self, message):
-        print message
-        if message["event"] == "connect":
-            self.event_dispatch.send(events.make_event('JoinEvent', id=self.id, version=message["version"], object=self))
-        elif message["event"] == "stats":
-            self.event_dispatch.send(events.make_event('WinEvent', id=self.id, seed=message["seed"], time=message["time"], moves=message["moves"], undos=message["undos"], won=message["won"]))
-        elif message["event"] == "tokenhash":
-            self.event_dispatch.send(events.make_event('TokenHashEvent', id=self.id, username=message["username"], nonce_hash=message["nonce_hash"]))
-        elif message["event"] == "login":
-            self.event_dispatch.send(events.make_event('LoginEvent', id=self.id, username=message["username"]))
-        elif message["event"] == "register":
-            self.event_dispatch.send(events.make_event('RegisterEvent', id=self.id, username=message["username"]))
-        elif message["event"] == "seedrequest":
-            self.event_dispatch.send(events.make_event('SeedRequestEvent', id=self.id))
-
-    def send_json(self, obj):
-        with self.lock:
-            self.push(json.dumps(obj)+"\r\n")
-            print ">" + json.dumps(obj)
+            self.disconnect("Idle timeout")
+
+    def handle_message(self, message, values):
+        self.active = True
+        if "log" in values:
+            # Up to MAX_LOG_LENGTH moves, too much to print on the loop
+            print message.name, "%d moves logged" % len(values["log"])
+        else:
+            print message.name, values
+        if message.name == "connect":
+            values["object"] = self
+        values["id"] = self.id
+        MessageChannel.handle_message(self, message, values)
+
+    def send_message(self, name, **values):
+        """
+        :param str name: Message name, see protocol.MESSAGES
+        """
+        self.push_frame(self.encode_message(name, values))
+        print ">%s %s" % (name, values)
+
+    def push_frame(self, frame):
+        """
+        :param str frame: Encoded message, may be shared with other connections
+        """
+        if self.state == "disconnected":
+            return
+        self.queued += len(frame)
+        if self.queued > self.MAX_QUEUED:
+            self.disconnect("Slow consumer")
+            return
+        if self.queued > self.HIGH_WATERMARK and self.backlog_timer is None:
+            self.backlog_timer = self.timers.schedule(self.SLOW_CONSUMER_TIMEOUT, self.disconnect, "Slow consumer")
+        self.push(frame)
+
+    def recv(self, buffer_size):
+        data = MessageChannel.recv(self, buffer_size)
+        self.bytes_in += len(data)
+        return data
+
+    def send(self, data):
+        sent = MessageChannel.send(self, data)
+        self.queued -= sent
+        self.bytes_out += sent
+        if self.backlog_timer is not None and self.queued <= self.LOW_WATERMARK:
+            self.timers.cancel(self.backlog_timer)
+            self.backlog_timer = None
+        return sent
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Self-pipe that wakes the loop out of select when another thread has
+    sent an event.
+    """
+    def __init__(self):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd)
+        os.close(read_fd)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, "\x00")
+        except OSError as e:
+            # Pipe full, a wakeup is already pending
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
 
 class FreecellServer(asyncore.dispatcher):
-    def __init__(self, host, port):
+    """
+    Runs the sockets and the event dispatch on one thread. The loop blocks
+    in poll until a socket is ready, the waker fires or a timer is due, and
+    events from incoming messages are dispatched as soon as the messages
+    are read.
+
+    A new connection has HANDSHAKE_TIMEOUT to send connect. Past
+    max_connections, new connections are closed as soon as they are
+    accepted.
+    """
+    # Longest wait in poll while idle, only bounds how long shutdown takes
+    IDLE_TIMEOUT = 1.0
+    # Dispatch time per pass before the sockets are served again
+    MAX_DISPATCH_TIME = 0.05
+    HANDSHAKE_TIMEOUT = 10.0
+    MAX_CONNECTIONS = 1000
+    # Connections the kernel holds for accept, past it new ones wait for a SYN retransmit
+    LISTEN_BACKLOG = 128
+    ACCEPTS_PER_PASS = 64
+
+    def __init__(self, host, port, max_connections=MAX_CONNECTIONS):
         """
         :param str host: Host
         :param int port: Port
+        :param int max_connections: Connections served at once
         """
         asyncore.dispatcher.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind((host, port))
-        self.listen(1)
+        self.listen(self.LISTEN_BACKLOG)
         self.event_dispatch = events.event_dispatch
         self.connections = {}
         """:type : dict[(str, int), FreecellConnection]"""
-        self.lock = threading.Lock()
+        self.max_connections = max_connections
+        self.timers = TimerWheel()
+        self.waker = Waker()
+        self.metrics_listener = None
+        """:type : MetricsListener | None"""
+        # Bytes of the connections already gone, the open ones are summed when read
+        self.closed_bytes_in = 0
+        self.closed_bytes_out = 0
+        self.metrics = MetricsRegistry()
+        self.add_metrics(self.metrics)
+
+    def add_metrics(self, metrics):
+        """
+        :param MetricsRegistry metrics: Registry
+        """
+        started = time.time()
+        connections = self.connections
+        event_counts = self.event_dispatch.count_events()
+        metrics.gauge("freecell_uptime_seconds", "Seconds since the server started", lambda: time.time() - started)
+        metrics.gauge("freecell_connections", "Open connections", lambda: len(connections))
+        metrics.gauge("freecell_connections_backlogged", "Connections with more than HIGH_WATERMARK queued",
+                      lambda: sum(1 for connection in connections.values() if connection.backlog_timer is not None))
+        self.accepted = metrics.counter("freecell_connections_accepted_total", "Connections accepted")
+        self.refused = metrics.counter("freecell_connections_refused_total", "Connections closed on accept, over max_connections")
+        metrics.counter("freecell_received_bytes_total", "Bytes received from clients",
+                        read=lambda: self.closed_bytes_in + sum(connection.bytes_in for connection in connections.values()))
+        metrics.counter("freecell_sent_bytes_total", "Bytes sent to clients",
+                        read=lambda: self.closed_bytes_out + sum(connection.bytes_out for connection in connections.values()))
+        metrics.gauge("freecell_dispatch_queue_depth", "Events waiting to be dispatched", self.event_dispatch.depth)
+        metrics.counter("freecell_events_total", "Events dispatched", label="type",
+                        read=lambda: {cls.__name__: count for cls, count in event_counts.items()})
+        metrics.gauge("freecell_timers", "Timers on the wheel", lambda: self.timers.count)
+        self.broadcast_time = metrics.histogram("freecell_broadcast_us", "Microseconds to encode and queue a broadcast")
+        self.broadcast_frames = metrics.counter("freecell_broadcast_frames_total", "Frames queued by broadcasts")
+
+    def serve_metrics(self, port, host="localhost"):
+        """
+        Serve the metrics as plain text over HTTP from the loop.
+        :param int port: Port
+        :param str host: Host, local only by default
+        """
+        self.metrics_listener = MetricsListener(self.metrics, self.timers, host, port)
 
     def run(self, shutdown_event):
-        shutdown_event.wait()
-        while shutdown_event.is_set():
-            MAX_FPS = 30
-            S_PER_FRAME = 1.0/MAX_FPS
-            start = time.time()
-            with self.lock:
-                asyncore.loop(timeout=0, count=1)
-                self.update_connections()
-
-            elapsed = time.time()-start
-            if elapsed < S_PER_FRAME:
-                time.sleep(S_PER_FRAME-elapsed)
-
-        for connection in self.connections.values():
-            connection.close_when_done()
-
-    def update_connections(self):
-        for addr, connection in self.connections.items():
-            if connection.state == "disconnected":
-                del self.connections[addr]
+        """
+        Serve until shutdown_event is cleared.
+        :param threading.Event shutdown_event: Set while running
+        """
+        try:
+            while shutdown_event.is_set():
+                timeout = self.IDLE_TIMEOUT if self.event_dispatch.empty() else 0
+                next_timer = self.timers.next_timeout(time.time())
+                if next_timer is not None:
+                    timeout = min(timeout, next_timer)
+                # poll, select cannot watch descriptors past FD_SETSIZE
+                asyncore.loop(timeout=timeout, count=1, use_poll=True)
+                # A handler or timer that raises loses its own work, not the server
+                try:
+                    self.event_dispatch.update(self.MAX_DISPATCH_TIME)
+                except Exception:
+                    traceback.print_exc()
+                try:
+                    self.timers.advance(time.time())
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            for connection in self.connections.values():
+                connection.close()
+            self.waker.close()
+            if self.metrics_listener is not None:
+                self.metrics_listener.close()
+            self.close()
+
+    def wake(self):
+        """
+        Make run() dispatch events sent from another thread. Thread safe.
+        """
+        self.waker.wake()
+
+    def remove_connection(self, connection):
+        """
+        on_close of every connection.
+        :param FreecellConnection connection: Closed connection
+        """
+        if self.connections.get(connection.addr) is connection:
+            del self.connections[connection.addr]
+            self.closed_bytes_in += connection.bytes_in
+            self.closed_bytes_out += connection.bytes_out
+
+    def broadcast(self, connections, name, **values):
+        """
+        Encode a message once per framing in use and queue the same frame
+        on every connection.
+        :param collections.Iterable[FreecellConnection] connections: Recipients
+        :param str name: Message name, see protocol.MESSAGES
+        """
+        start = time.time()
+        frames = {}
+        sent = 0
+        for connection in connections:
+            frame = frames.get(connection.framing)
+            if frame is None:
+                frame = frames[connection.framing] = encode(SERVER, name, values, connection.framing)
+            connection.push_frame(frame)
+            sent += 1
+        self.broadcast_time.add((time.time() - start) * 1e6)
+        self.broadcast_frames.value += sent
+        print ">>%s %s" % (name, values)
 
     def handle_accept(self):
-        pair = self.accept()
-        if pair is not None:
+        # Drain the backlog, one accept per pass cannot keep up with a burst of connects
+        for attempt in xrange(self.ACCEPTS_PER_PASS):
+            pair = self.accept()
+            if pair is None:
+                return
             sock, addr = pair
-            handler = FreecellConnection(sock, addr, self.lock)
+            if len(self.connections) >= self.max_connections:
+                print "Refused %s:%d, %d connections" % (addr[0], addr[1], len(self.connections))
+                self.refused.value += 1
+                sock.close()
+                continue
+            self.accepted.value += 1
+            # Lets the kernel find peers that vanished without a FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Replies are small and often two in a row, such as ticket and loggedin,
+            # Nagle would hold the second until the client's delayed ACK
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            handler = FreecellConnection(sock, addr, self.timers, self.remove_connection)
+            handler.expect(self.HANDSHAKE_TIMEOUT, "Handshake timed out")
             self.connections[addr] = handler
@@ -0,0 +1,63 @@
+import re
+
+from ..client.board import Deck, Tableau, SUITES
+from ..client.history import decode_moves, LOG_UNDO, LOG_ROLLBACK
+
+# Longest move log the server will replay
+MAX_LOG_LENGTH = 20000
+
+# One or more moves, each a source (column or cell) and a destination
+ACTION_PATTERN = re.compile(r"^(?:(?:C[0-7]|T[0-3])(?:C[0-7]|T[0-3]|F[cdhs]))+$")
+
+def verify_game(seed, log, moves, undos, won):
+    """
+    Re-deal a seed and replay a submitted move log, checking every move is
+    legal and that the claimed result matches. Runs in a worker process.
+    :param int seed: Seed
+    :param list[str] log: UndoJournal.log from the client
+    :param int moves: Claimed moves, single card moves however they were batched
+    :param int undos: Claimed undos
+    :param bool won: Claimed win
+    :return: (valid, reason)
+    :rtype: (bool, str)
+    """
+    if len(log) > MAX_LOG_LENGTH:
+        return False, "move log too long"
+
+    deck = Deck()
+    deck.shuffle(seed)
+    table = Tableau()
+    table.setup(deck)
+
+    entries = []
+    replayed_moves = 0
+    replayed_undos = 0
+    for action in log:
+        if action in (LOG_UNDO, LOG_ROLLBACK):
+            if len(entries) == 0:
+                return False, "undo with nothing to undo"
+            undone = entries.pop()
+            for source, dest in reversed(undone):
+                table.unmove(source, dest)
+            replayed_moves -= len(undone)
+            if action == LOG_UNDO:
+                replayed_undos += 1
+            continue
+
+        if not isinstance(action, basestring) or not ACTION_PATTERN.match(action):
+            return False, "malformed action %r" % (action,)
+        action_moves = decode_moves(str(action))
+        for source, dest in action_moves:
+            if not table.can_move(source, dest):
+                return False, "illegal move %s to %s" % (source, dest)
+            table.move(source, dest)
+        entries.append(action_moves)
+        replayed_moves += len(action_moves)
+
+    solved = all(table.foundation_value(suite) == 13 for suite in SUITES)
+    if solved != won:
+        return False, "claimed %s, replay %s" % (["loss", "win"][won], ["lost", "won"][solved])
+    if replayed_moves != moves or replayed_undos != undos:
+        return False, "claimed %d moves %d undos, replay has %d moves %d undos" % \
+            (moves, undos, replayed_moves, replayed_undos)
+    return True, ""
@@ -0,0 +1,101 @@
+import math
+import time
+import traceback
+
+class Timer(object):
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        """:type : int (tick the timer fires on)"""
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        """:type : set | None (None once fired or cancelled)"""
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel: a ring of slots, each a set of the timers whose
+    expiry tick hashes to it. Scheduling and cancelling are a set add and
+    discard, advancing visits one slot per elapsed tick and only fires the
+    timers that are due, the rest are on a later turn of the wheel.
+
+    Timers fire up to one tick late, never early. Only for the thread that
+    calls advance().
+    """
+    def __init__(self, tick=1.0, slots=512):
+        """
+        :param float tick: Seconds per slot
+        :param int slots: Slots in the ring
+        """
+        self.tick = tick
+        self.slots = [set() for x in range(slots)]
+        self.current = int(time.time() / tick)
+        """:type : int (last tick advanced to)"""
+        self.count = 0
+
+    def schedule(self, delay, callback, *args):
+        """
+        :param float delay: Seconds from now
+        :param callable callback: Called with args when the timer fires
+        :rtype: Timer
+        """
+        expires = max(int(math.ceil((time.time() + delay) / self.tick)), self.current + 1)
+        timer = Timer(expires, callback, args)
+        timer.slot = self.slots[expires % len(self.slots)]
+        timer.slot.add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """
+        :param Timer | None timer: Timer, may already have fired
+        """
+        if timer is None:
+            return
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+        # Also stops it if it is due in the advance() running now
+        timer.callback = None
+
+    def advance(self, now):
+        """
+        Fire the timers due by now.
+        :param float now: time.time()
+        :return: Timers due
+        :rtype: int
+        """
+        target = int(now / self.tick)
+        due = []
+        # Past a whole turn every slot has been visited once
+        for tick in xrange(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            if slot:
+                for timer in [timer for timer in slot if timer.expires <= target]:
+                    slot.discard(timer)
+                    timer.slot = None
+                    due.append(timer)
+        self.current = max(self.current, target)
+        self.count -= len(due)
+
+        # After the scan, so callbacks can schedule and cancel freely. The due
+        # timers are already off the wheel, one that raises must not lose the rest
+        for timer in due:
+            if timer.callback is not None:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+        return len(due)
+
+    def next_timeout(self, now):
+        """
+        :param float now: time.time()
+        :return: Seconds until the next tick, None if nothing is scheduled
+        :rtype: float | None
+        """
+        if not self.count:
+            return None
+        return max((self.current + 1) * self.tick - now, 0.0)
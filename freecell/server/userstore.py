@@ -0,0 +1,149 @@
+import os.path
+import pickle
+import Queue
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple
+
+DATABASE_PATH = "~/.freecell_users.db"
+# Pickled dict from before the store, imported when the database is created
+LEGACY_PATH = "~/.freecell_logins"
+
+UserRecord = namedtuple('UserRecord', ['token_hash', 'salt'])
+
+class UserStore(object):
+    """
+    Users in SQLite, in WAL mode so reads never wait on the writer. The
+    database is opened on first use. Writes are queued to a background
+    thread that commits them in batches; until then they are served from
+    pending, so a user can log in straight after registering.
+
+    get() and add() must be called from one thread, the server loop.
+    """
+    def __init__(self, path=DATABASE_PATH, legacy_path=LEGACY_PATH):
+        """
+        :param str path: Database file
+        :param str legacy_path: Pickle to migrate, None to skip
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.db = None
+        """:type : sqlite3.Connection | None (readers, on the loop thread)"""
+        self.pending = {}
+        """:type : dict[str, UserRecord] (queued and not yet committed)"""
+        self.pending_lock = threading.Lock()
+        self.writes = Queue.Queue()
+        self.writer = None
+        """:type : threading.Thread | None"""
+
+    def connect(self):
+        """
+        :rtype: sqlite3.Connection
+        """
+        db = sqlite3.connect(os.path.expanduser(self.path))
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def open(self):
+        if self.db is not None:
+            return
+        db = self.connect()
+        with db:
+            created = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is None
+            db.execute("CREATE TABLE IF NOT EXISTS users "
+                       "(username TEXT PRIMARY KEY, token_hash TEXT NOT NULL, salt TEXT NOT NULL, created REAL NOT NULL)")
+            if created:
+                self.migrate(db)
+        self.db = db
+
+    def migrate(self, db):
+        """
+        Import the legacy pickle into a new database. The pickle is left in place.
+        :param sqlite3.Connection db: Database, inside a transaction
+        """
+        if self.legacy_path is None or not os.path.isfile(os.path.expanduser(self.legacy_path)):
+            return
+        with open(os.path.expanduser(self.legacy_path)) as db_file:
+            users = pickle.load(db_file)
+        now = time.time()
+        db.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)",
+                       ((username, token_hash, salt, now) for username, (token_hash, salt) in users.items()))
+        print "Migrated %d users from %s" % (len(users), self.legacy_path)
+
+    def get(self, username):
+        """
+        :param str username: Username
+        :rtype: UserRecord | None
+        """
+        with self.pending_lock:
+            record = self.pending.get(username)
+        if record is not None:
+            return record
+        self.open()
+        row = self.db.execute("SELECT token_hash, salt FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return UserRecord(token_hash=str(row[0]), salt=str(row[1]))
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def add(self, username, token_hash, salt):
+        """
+        Queue a new user. Visible to get() at once, committed in the background.
+        :param str username: Username
+        :param str token_hash: sha256 of the login token and salt
+        :param str salt: Salt
+        """
+        self.open()
+        record = UserRecord(token_hash=token_hash, salt=salt)
+        with self.pending_lock:
+            self.pending[username] = record
+        self.writes.put((username, record, time.time()))
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def write_loop(self):
+        db = self.connect()
+        while True:
+            batch = [self.writes.get()]
+            while True:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except Queue.Empty:
+                    break
+
+            rows = [(username, record.token_hash, record.salt, created)
+                    for username, record, created in batch if username is not None]
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                # Kept in pending, so the users still work until a restart
+                print "User store write failed: %s" % e
+            else:
+                with self.pending_lock:
+                    for username, record, created in batch:
+                        if username is not None and self.pending.get(username) is record:
+                            del self.pending[username]
+
+            if any(username is None for username, record, created in batch):
+                db.close()
+                return
+
+    def close(self):
+        """
+        Wait for queued writes to be committed, then close.
+        """
+        if self.writer is not None:
+            self.writes.put((None, None, None))
+            self.writer.join()
+            self.writer = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
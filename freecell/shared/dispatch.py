@@ -0,0 +1,273 @@
+import threading
+import time
+
+from collections import deque
+
+from instrument import DispatchStats, Histogram, callback_name
+
+class EventDispatch(object):
+    """
+    Event queue shared by the client and the server. Each priority has its
+    own FIFO deque, lower priorities are dispatched first. Order within a
+    priority is the order of the appends, it never depends on the clock or
+    on comparing events.
+
+    send() takes no lock: deque.append is atomic in CPython, so any thread
+    may send. update() must only be called from one
+    thread.
+
+    Handlers are kept in immutable tuples that register/unregister replace
+    copy-on-write, and update() looks them up by event class. Callbacks can
+    register and unregister during dispatch; the change applies from the
+    next event on.
+
+    Handlers registered with a scope only get events whose id attribute
+    equals the scope, such as the events of one connection on the server.
+    They are found with one lookup on (event type, id), whatever the
+    number of scopes.
+
+    Instrumentation is off unless enable_stats() is called. It timestamps
+    every send and times every callback. count_events() only counts the
+    events dispatched of each type, which costs a dict update per event.
+    """
+    def __init__(self):
+        self.queues = {}
+        """:type : dict[int, deque]"""
+        self.priorities = ()
+        """:type : tuple[deque] (queues in priority order)"""
+        self.registered = {}
+        """:type : dict[str, tuple]"""
+        self.handlers = {}
+        """:type : dict[type, tuple] (registered, keyed by class, filled in by update())"""
+        self.scoped = {}
+        """:type : dict[(str, str), tuple] (by event type and id, changed in place: only ever read with get)"""
+        self.lock = threading.Lock()
+        self.stats = None
+        """:type : DispatchStats | None"""
+        self.counts = None
+        """:type : dict[type, int] | None (events dispatched by class)"""
+
+    def count_events(self):
+        """
+        Start counting the events dispatched of each type.
+        :return: Counts by event class, updated in place by update()
+        :rtype: dict[type, int]
+        """
+        if self.counts is None:
+            self.counts = {}
+        return self.counts
+
+    def enable_stats(self):
+        """
+        Start recording queue wait, handler time and queue depth per event type.
+        :rtype: DispatchStats
+        """
+        if self.stats is None:
+            self.stats = DispatchStats()
+        return self.stats
+
+    def register(self, callback, event_types, scope=None):
+        """
+        :param callable callback: Callback for event types
+        :param list[str] event_types: List of event types (as strings)
+        :param str scope: Only get events with this id, all events if None
+        """
+        if scope is not None:
+            return self.register_scoped(callback, event_types, scope)
+        with self.lock:
+            registered = dict(self.registered)
+            for event_type in event_types:
+                callbacks = registered.get(event_type, ())
+                if callback not in callbacks:
+                    registered[event_type] = callbacks + (callback,)
+            self.swap_handlers(registered, event_types)
+
+    def unregister(self, callback, event_types, scope=None):
+        """
+        :param callable callback: Callback for event types
+        :param list[str] event_types: List of event types (as strings)
+        :param str scope: Scope it was registered with
+        :rtype bool:
+        """
+        if scope is not None:
+            return self.unregister_scoped(callback, event_types, scope)
+        with self.lock:
+            registered = dict(self.registered)
+            for event_type in event_types:
+                callbacks = registered.get(event_type, ())
+                if callback in callbacks:
+                    registered[event_type] = tuple(x for x in callbacks if x != callback)
+            self.swap_handlers(registered, event_types)
+
+    def register_scoped(self, callback, event_types, scope):
+        with self.lock:
+            for event_type in event_types:
+                key = (event_type, scope)
+                callbacks = self.scoped.get(key, ())
+                if callback not in callbacks:
+                    self.scoped[key] = callbacks + (callback,)
+
+    def unregister_scoped(self, callback, event_types, scope):
+        with self.lock:
+            for event_type in event_types:
+                key = (event_type, scope)
+                callbacks = tuple(x for x in self.scoped.get(key, ()) if x != callback)
+                if callbacks:
+                    self.scoped[key] = callbacks
+                else:
+                    self.scoped.pop(key, None)
+
+    def swap_handlers(self, registered, event_types):
+        """
+        Publish new handler tables. Must hold the lock.
+        """
+        handlers = dict(self.handlers)
+        for cls in self.handlers:
+            if cls.__name__ in event_types:
+                handlers[cls] = registered.get(cls.__name__, ())
+        # registered first: update() reads handlers first, then registered
+        self.registered = registered
+        self.handlers = handlers
+
+    def get_handlers(self, cls):
+        """
+        :param type cls: Event class
+        :rtype: tuple[callable]
+        """
+        handlers = self.handlers
+        callbacks = handlers.get(cls)
+        if callbacks is None:
+            callbacks = handlers[cls] = self.registered.get(cls.__name__, ())
+        return callbacks
+
+    def handlers_for(self, event):
+        """
+        :param event: Event
+        :return: Global handlers for its type, then those scoped to its id
+        :rtype: tuple[callable]
+        """
+        cls = type(event)
+        callbacks = self.handlers.get(cls)
+        if callbacks is None:
+            callbacks = self.get_handlers(cls)
+        if self.scoped:
+            scoped = self.scoped.get((cls.__name__, getattr(event, "id", None)))
+            if scoped:
+                return callbacks + scoped
+        return callbacks
+
+    def add_priority(self, priority):
+        """
+        :param int priority: Priority
+        :rtype: deque
+        """
+        with self.lock:
+            if priority not in self.queues:
+                queues = dict(self.queues)
+                queues[priority] = deque()
+                self.queues = queues
+                self.priorities = tuple(queues[key] for key in sorted(queues))
+            return self.queues[priority]
+
+    def send(self, event, priority=5):
+        """
+        :param namedtuple event: Event
+        :param int priority: Priority, lower is dispatched first
+        """
+        queue = self.queues.get(priority)
+        if queue is None:
+            queue = self.add_priority(priority)
+        if self.stats is None:
+            queue.append((event,))
+        else:
+            queue.append((event, time.time()))
+
+    def empty(self):
+        """
+        :rtype: bool
+        """
+        for queue in self.priorities:
+            if queue:
+                return False
+        return True
+
+    def depth(self):
+        """
+        :return: Events queued
+        :rtype: int
+        """
+        return sum(len(queue) for queue in self.priorities)
+
+    def next_item(self):
+        """
+        :return: (event[, send time]) with the lowest priority, None if empty
+        """
+        for queue in self.priorities:
+            if queue:
+                return queue.popleft()
+        return None
+
+    def update(self, max_time):
+        """
+        Dispatch queued events until the queue is empty or max_time is up.
+        :param float max_time: Seconds
+        :return: True if the queue was emptied
+        :rtype: bool
+        """
+        if self.stats is not None:
+            return self.update_instrumented(max_time)
+
+        counts = self.counts
+        start = time.time()
+        while True:
+            item = self.next_item()
+            if item is None:
+                return True
+            event = item[0]
+            if counts is not None:
+                cls = type(event)
+                counts[cls] = counts.get(cls, 0) + 1
+            for callback in self.handlers_for(event):
+                callback(event)
+
+            if time.time() - start >= max_time:
+                return False
+
+    def update_instrumented(self, max_time):
+        """
+        update() that records into self.stats.
+        """
+        stats = self.stats
+        counts = self.counts
+        start = time.time()
+        while True:
+            item = self.next_item()
+            if item is None:
+                return True
+            event = item[0]
+            if counts is not None:
+                cls = type(event)
+                counts[cls] = counts.get(cls, 0) + 1
+            now = time.time()
+            event_stats = stats.event_type(type(event).__name__)
+            event_stats.count += 1
+            # Sent before enable_stats() if there is no timestamp
+            if len(item) > 1:
+                event_stats.wait.add((now - item[1]) * 1e6)
+            stats.depth.add(self.depth())
+
+            handling = 0.0
+            for callback in self.handlers_for(event):
+                before = time.time()
+                callback(event)
+                elapsed = time.time() - before
+                handling += elapsed
+                name = callback_name(callback)
+                histogram = event_stats.callbacks.get(name)
+                if histogram is None:
+                    histogram = event_stats.callbacks[name] = Histogram()
+                histogram.add(elapsed * 1e6)
+            event_stats.handling.add(handling * 1e6)
+
+            if time.time() - start >= max_time:
+                return False
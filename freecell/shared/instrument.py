@@ -0,0 +1,129 @@
+import signal
+import sys
+import time
+
+class Histogram(object):
+    """
+    Counts in power of two buckets: bucket i holds values below 2**i and
+    at least 2**(i-1). Adding is a bit_length and an increment, percentiles
+    are accurate to a factor of two.
+    """
+    BUCKETS = 64
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """
+        :param float value: Value, negative values count as 0
+        """
+        bucket = int(value).bit_length() if value >= 1 else 0
+        self.counts[bucket if bucket < self.BUCKETS else self.BUCKETS - 1] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        :param float fraction: 0.5 for the median
+        :return: Upper bound of the bucket holding the percentile
+        :rtype: float
+        """
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(float(1 << bucket), self.max)
+        return self.max
+
+    def mean(self):
+        """
+        :rtype: float
+        """
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        :return: "p50/p99/max"
+        :rtype: str
+        """
+        return "%d/%d/%d" % (self.percentile(0.5), self.percentile(0.99), self.max)
+
+def callback_name(callback):
+    """
+    :param callable callback: Function or bound method
+    :return: "Class.method" or "function"
+    :rtype: str
+    """
+    owner = getattr(callback, "im_self", None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__, callback.__name__)
+    return getattr(callback, "__name__", repr(callback))
+
+class EventTypeStats(object):
+    def __init__(self):
+        self.count = 0
+        self.wait = Histogram()
+        """:type : Histogram (microseconds from send to dispatch)"""
+        self.handling = Histogram()
+        """:type : Histogram (microseconds in all callbacks)"""
+        self.callbacks = {}
+        """:type : dict[str, Histogram] (microseconds per callback, by callback_name)"""
+
+class DispatchStats(object):
+    """
+    What EventDispatch.update records when instrumented, see
+    EventDispatch.enable_stats.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.event_types = {}
+        """:type : dict[str, EventTypeStats]"""
+        self.depth = Histogram()
+        """:type : Histogram (events still queued after each dispatch)"""
+
+    def event_type(self, name):
+        """
+        :param str name: Event type
+        :rtype: EventTypeStats
+        """
+        stats = self.event_types.get(name)
+        if stats is None:
+            stats = self.event_types[name] = EventTypeStats()
+        return stats
+
+    def report(self):
+        """
+        :rtype: str
+        """
+        elapsed = max(time.time() - self.start, 1e-6)
+        total = sum(stats.count for stats in self.event_types.values())
+        lines = ["%d events in %.1fs, %.1f/s, queue depth %s (p50/p99/max)" %
+                 (total, elapsed, total / elapsed, self.depth.summary()),
+                 "%-44s %8s %10s %20s %20s" % ("event type / callback", "count", "events/s", "wait us", "handler us")]
+        for name, stats in sorted(self.event_types.items(), key=lambda item: -item[1].handling.total):
+            lines.append("%-44s %8d %10.1f %20s %20s" %
+                         (name, stats.count, stats.count / elapsed, stats.wait.summary(), stats.handling.summary()))
+            for callback, histogram in sorted(stats.callbacks.items(), key=lambda item: -item[1].total):
+                lines.append("  %-42s %8d %10s %20s %20s" % (callback, histogram.count, "", "", histogram.summary()))
+        return "\n".join(lines)
+
+def dump_on_signal(stats, signum=signal.SIGUSR1, stream=sys.stderr):
+    """
+    Write stats.report() to stream whenever the process gets signum. Only
+    works from the main thread.
+    :param DispatchStats stats: Stats to report
+    :param int signum: Signal
+    :param file stream: Output
+    """
+    def dump(signum, frame):
+        stream.write(stats.report() + "\n")
+        stream.flush()
+    signal.signal(signum, dump)
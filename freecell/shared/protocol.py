@@ -0,0 +1,204 @@
+import asynchat
+import json
+import struct
+
+from collections import namedtuple
+
+# Sides of a connection
+CLIENT = "client"
+SERVER = "server"
+
+# Framings, see MessageChannel. Every connection starts with JSON, BINARY
+# is offered in "connect" and accepted in "welcome"
+JSON = "json"
+BINARY = "binary"
+FRAMINGS = (BINARY, JSON)
+""":type : tuple[str] (preference order)"""
+
+# Binary frame header: payload length, type id. The length must leave the
+# first byte zero, which is how a binary frame is told apart from JSON text
+HEADER = struct.Struct("!IH")
+MAX_FRAME_SIZE = 0xFFFFFF
+
+Message = namedtuple('Message', ['name', 'type_id', 'sender', 'fields', 'defaults', 'event'])
+
+MESSAGES = [
+    # name, type id, sender, fields, defaults for fields older peers leave out, event on the receiving side
+    Message("connect", 1, CLIENT, ("version", "framing"), {"framing": []}, "JoinEvent"),
+    Message("stats", 2, CLIENT, ("seed", "time", "moves", "undos", "won", "log"), {"log": []}, "WinEvent"),
+    Message("login", 3, CLIENT, ("username",), {}, "LoginEvent"),
+    Message("register", 4, CLIENT, ("username",), {}, "RegisterEvent"),
+    Message("tokenhash", 5, CLIENT, ("username", "nonce_hash"), {}, "TokenHashEvent"),
+    Message("seedrequest", 6, CLIENT, (), {}, "SeedRequestEvent"),
+    Message("joinroom", 7, CLIENT, ("room",), {}, "JoinRoomEvent"),
+    Message("auth", 8, CLIENT, ("username", "nonce_hash", "ticket"), {"nonce_hash": "", "ticket": ""}, "AuthRequestEvent"),
+
+    Message("welcome", 32, SERVER, ("version", "framing", "nonce"), {"nonce": None}, None),
+    Message("badversion", 33, SERVER, ("min_version",), {}, None),
+    Message("seed", 34, SERVER, ("seed",), {}, "SeedEvent"),
+    Message("stats", 35, SERVER, ("id", "seed", "time", "moves", "undos", "won"), {}, None),
+    Message("verified", 36, SERVER, ("id", "seed", "valid", "reason"), {}, None),
+    Message("nonce", 37, SERVER, ("nonce", "salt"), {}, "NonceEvent"),
+    Message("unknownuser", 38, SERVER, ("username",), {}, "UnknownUserEvent"),
+    Message("nametaken", 39, SERVER, ("username",), {}, "NameTakenEvent"),
+    Message("logintoken", 40, SERVER, ("username", "token"), {}, "LoginTokenEvent"),
+    Message("loggedin", 41, SERVER, ("username",), {}, "LoggedInEvent"),
+    Message("loginfailed", 42, SERVER, ("username",), {}, "LoginFailedEvent"),
+    Message("joinedroom", 43, SERVER, ("room", "players"), {}, "RoomEvent"),
+    Message("ticket", 44, SERVER, ("username", "ticket", "expires"), {}, "TicketEvent"),
+    ]
+
+messages_by_name = {(message.sender, message.name): message for message in MESSAGES}
+""":type : dict[(str, str), Message]"""
+messages_by_id = {message.type_id: message for message in MESSAGES}
+""":type : dict[int, Message]"""
+assert len(messages_by_name) == len(messages_by_id) == len(MESSAGES)
+
+class ProtocolError(ValueError):
+    pass
+
+def encode(sender, name, values, framing=JSON):
+    """
+    :param str sender: CLIENT or SERVER
+    :param str name: Message name
+    :param dict values: Field values, extra keys are ignored
+    :param str framing: JSON or BINARY
+    :return: One complete frame
+    :rtype: str
+    """
+    message = messages_by_name[(sender, name)]
+    if framing == BINARY:
+        payload = json.dumps([values[field] if field in values else message.defaults[field] for field in message.fields],
+                             separators=(',', ':'))
+        if len(payload) > MAX_FRAME_SIZE:
+            raise ProtocolError("'%s' message too large" % name)
+        return HEADER.pack(len(payload), message.type_id) + payload
+    else:
+        obj = {field: values[field] for field in message.fields if field in values}
+        obj["event"] = name
+        return json.dumps(obj, separators=(',', ':')) + "\r\n"
+
+def decode_json(sender, line):
+    """
+    :param str sender: Side that sent the line
+    :param str line: JSON text without the terminator
+    :return: Message, and the field values with defaults filled in. None if the message is unknown
+    :rtype: (Message, dict) | None
+    """
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        raise ProtocolError("Malformed JSON message")
+    if not isinstance(obj, dict) or "event" not in obj:
+        return None
+
+    message = messages_by_name.get((sender, obj["event"]))
+    if message is None:
+        return None
+    values = {}
+    for field in message.fields:
+        if field in obj:
+            values[field] = obj[field]
+        elif field in message.defaults:
+            values[field] = message.defaults[field]
+        else:
+            raise ProtocolError("'%s' message is missing '%s'" % (message.name, field))
+    return message, values
+
+def decode_binary(sender, type_id, payload):
+    """
+    :param str sender: Side that sent the frame
+    :param int type_id: Message type id from the header
+    :param str payload: JSON array of the field values
+    :rtype: (Message, dict) | None
+    """
+    message = messages_by_id.get(type_id)
+    if message is None or message.sender != sender:
+        return None
+    try:
+        array = json.loads(payload)
+    except ValueError:
+        raise ProtocolError("Malformed binary message")
+    if not isinstance(array, list) or len(array) != len(message.fields):
+        raise ProtocolError("'%s' message has %s fields" % (message.name, len(array) if isinstance(array, list) else "no"))
+    return message, dict(zip(message.fields, array))
+
+class MessageChannel(asynchat.async_chat):
+    """
+    Connection that reads both framings at any time. A frame starting with
+    a zero byte is binary: HEADER, then a JSON array of the message fields
+    in table order. Anything else is a JSON object terminated by "\\r\\n".
+    framing only decides what is sent, so switching it needs no sync with
+    the peer.
+    """
+    sender = None
+    """:type : str (CLIENT or SERVER, the side this end is)"""
+    event_types = {}
+    """:type : dict[str, type] (event classes by name, for handle_message)"""
+    event_dispatch = None
+    """:type : EventDispatch"""
+
+    def __init__(self, sock=None):
+        asynchat.async_chat.__init__(self, sock=sock)
+        self.peer = SERVER if self.sender == CLIENT else CLIENT
+        self.framing = JSON
+        self.buffer = []
+        self.reading = "start"
+        self.frame_type = None
+        self.set_terminator(1)
+
+    def encode_message(self, name, values):
+        """
+        :param str name: Message name
+        :param dict values: Field values
+        :rtype: str
+        """
+        return encode(self.sender, name, values, self.framing)
+
+    def handle_message(self, message, values):
+        """
+        Send the message's event to event_dispatch. Messages without an
+        event are dropped, subclasses that handle any override this.
+        :param Message message: Message received
+        :param dict values: Field values
+        """
+        if message.event is not None:
+            self.event_dispatch.send(self.event_types[message.event](**values))
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data = "".join(self.buffer)
+        self.buffer = []
+
+        if self.reading == "start":
+            if data == "\x00":
+                self.reading = "header"
+                self.set_terminator(HEADER.size - 1)
+            elif not data.isspace():
+                self.buffer.append(data)
+                self.reading = "line"
+                self.set_terminator("\r\n")
+            return
+
+        if self.reading == "header":
+            length, self.frame_type = HEADER.unpack("\x00" + data)
+            if length == 0:
+                raise ProtocolError("Empty binary frame")
+            self.reading = "payload"
+            self.set_terminator(length)
+            return
+
+        reading = self.reading
+        self.reading = "start"
+        self.set_terminator(1)
+        if reading == "payload":
+            decoded = decode_binary(self.peer, self.frame_type, data)
+        else:
+            decoded = decode_json(self.peer, data)
+
+        if decoded is None:
+            print "Unknown message received"
+        else:
+            self.handle_message(*decoded)
@@ -0,0 +1,275 @@
+import heapq
+import sys
+import time
+
+from .client.board import Tableau, Deck, max_sequence, autoplay, NO_CARD, NUM_CARDS, NUM_CELLS, NUM_COLUMNS, SUITES, \
+    CARD_VALUE, CARD_SUITE, CAN_STACK, \
+    CELLS_OFFSET, FOUNDATIONS_OFFSET, HEIGHTS_OFFSET, COLUMNS_OFFSET, COLUMN_SIZE
+from .client.events import MoveEvent
+
+# Single byte needles for bytearray.count/index
+NO_CARD_BYTE = bytearray([NO_CARD])
+ZERO_BYTE = bytearray([0])
+
+# Weight of the path length against the heuristic, lower is greedier
+PATH_WEIGHT = 0.5
+BLOCKING_WEIGHT = 0.5
+
+def position_key(packed):
+    """
+    Key that is equal for tables that only differ in the order of their
+    free cells or columns.
+    :param bytearray packed: Packed table
+    :rtype: bytes
+    """
+    columns = []
+    for colno in range(NUM_COLUMNS):
+        start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+        columns.append(bytes(packed[start:start + packed[HEIGHTS_OFFSET + colno]]))
+    columns.sort()
+    return bytes(packed[FOUNDATIONS_OFFSET:HEIGHTS_OFFSET]) + \
+        bytes(bytearray(sorted(packed[CELLS_OFFSET:CELLS_OFFSET + NUM_CELLS]))) + \
+        "|".join(columns)
+
+def heuristic(packed):
+    """
+    Estimated number of moves left: cards not on the foundations, cards
+    buried above a lower card of their column, and cards covering the next
+    card each foundation needs.
+    :param bytearray packed: Packed table
+    :rtype: float
+    """
+    found = packed[FOUNDATIONS_OFFSET:HEIGHTS_OFFSET]
+    buried = 0
+    blocking = 0
+    empty_columns = 0
+    for colno in range(NUM_COLUMNS):
+        height = packed[HEIGHTS_OFFSET + colno]
+        if height == 0:
+            empty_columns += 1
+            continue
+        start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+        lowest = 14
+        for slot in range(start, start + height):
+            code = packed[slot]
+            value = CARD_VALUE[code]
+            if value > lowest:
+                buried += 1
+            else:
+                lowest = value
+            if found[CARD_SUITE[code]] == value - 1:
+                blocking += start + height - slot - 1
+    used_cells = NUM_CELLS - packed[CELLS_OFFSET:CELLS_OFFSET + NUM_CELLS].count(NO_CARD_BYTE)
+    return (NUM_CARDS - sum(found)) + buried + BLOCKING_WEIGHT * blocking + 0.5 * used_cells - 0.5 * empty_columns
+
+class SolverStats(object):
+    def __init__(self):
+        self.nodes_expanded = 0
+        self.nodes_generated = 0
+        self.peak_nodes = 0
+        self.peak_memory = 0
+        """:type: int (estimated bytes held by the transposition table and open list)"""
+        self.elapsed = 0.0
+        self.result = None
+        """:type: str | None ("solved", "unsolvable", "node budget", "time budget")"""
+
+    def __str__(self):
+        return "%s: %d expanded, %d generated, peak %d nodes (~%dKiB), %.3fs" % \
+               (self.result, self.nodes_expanded, self.nodes_generated, self.peak_nodes,
+                self.peak_memory / 1024, self.elapsed)
+
+class Solver(object):
+    """
+    Weighted A* search over packed tables with a transposition table.
+    Safe foundation moves are played automatically after every move, the
+    same way FreeCellLogic plays them, and are left out of the solution.
+    """
+    def __init__(self, node_budget=200000, time_budget=5.0):
+        """
+        :param int node_budget: Maximum nodes to expand
+        :param float time_budget: Maximum seconds to search
+        """
+        self.node_budget = node_budget
+        self.time_budget = time_budget
+        self.stats = SolverStats()
+
+    def solve_seed(self, seed):
+        """
+        :param int seed: Deal seed
+        :rtype: list[MoveEvent] | None
+        """
+        deck = Deck()
+        deck.shuffle(seed)
+        table = Tableau()
+        table.setup(deck)
+        return self.solve(table)
+
+    def solve(self, table):
+        """
+        :param Tableau table: Table to solve, not modified
+        :return: Moves to play, None if no solution was found within budget
+        :rtype: list[MoveEvent] | None
+        """
+        self.stats = stats = SolverStats()
+        start = time.time()
+        deadline = start + self.time_budget
+
+        packed = bytearray(table.packed)
+        autoplay(packed)
+
+        # parents[i] is (parent index, move) for node i
+        parents = [(None, None)]
+        seen = {position_key(packed): 0}
+        frontier = [(heuristic(packed), 0, 0, packed)]
+        peak_frontier = 1
+
+        while frontier:
+            f, g, index, packed = heapq.heappop(frontier)
+
+            if sum(packed[FOUNDATIONS_OFFSET:HEIGHTS_OFFSET]) == NUM_CARDS:
+                stats.result = "solved"
+                break
+
+            stats.nodes_expanded += 1
+            if stats.nodes_expanded > self.node_budget:
+                stats.result = "node budget"
+                break
+            if stats.nodes_expanded & 0xFF == 0 and time.time() > deadline:
+                stats.result = "time budget"
+                break
+
+            for move, child in self.children(packed):
+                autoplay(child)
+                key = position_key(child)
+                if key in seen and seen[key] <= g + 1:
+                    continue
+                seen[key] = g + 1
+                parents.append((index, move))
+                stats.nodes_generated += 1
+                heapq.heappush(frontier, (heuristic(child) + PATH_WEIGHT * (g + 1), g + 1, len(parents) - 1, child))
+
+            peak_frontier = max(peak_frontier, len(frontier))
+        else:
+            stats.result = "unsolvable"
+
+        # Every generated node keeps a transposition key and a parent link, open ones also keep their table
+        stats.peak_nodes = len(parents)
+        stats.peak_memory = len(parents) * (sys.getsizeof(position_key(packed)) + sys.getsizeof(parents[0]) + 24) + \
+            peak_frontier * (sys.getsizeof(packed) + sys.getsizeof(frontier[0] if frontier else (0, 0, 0, 0)))
+        stats.elapsed = time.time() - start
+
+        if stats.result != "solved":
+            return None
+
+        moves = []
+        while parents[index][0] is not None:
+            index, move = parents[index]
+            moves.append(move)
+        moves.reverse()
+        return moves
+
+    def children(self, packed):
+        """
+        Every useful move from a table, and the table after it.
+        :param bytearray packed: Packed table
+        :rtype: list[(MoveEvent, bytearray)]
+        """
+        children = []
+        heights = packed[HEIGHTS_OFFSET:HEIGHTS_OFFSET + NUM_COLUMNS]
+        cells = packed[CELLS_OFFSET:CELLS_OFFSET + NUM_CELLS]
+        free_cells = cells.count(NO_CARD_BYTE)
+        free_cell = cells.index(NO_CARD_BYTE) if free_cells else -1
+        empty_columns = heights.count(ZERO_BYTE)
+        empty_column = heights.index(ZERO_BYTE) if empty_columns else -1
+
+        tops = [NO_CARD] * NUM_COLUMNS
+        for colno in range(NUM_COLUMNS):
+            if heights[colno] > 0:
+                tops[colno] = packed[COLUMNS_OFFSET + colno * COLUMN_SIZE + heights[colno] - 1]
+
+        # Free cells to foundations and columns
+        for cellno in range(NUM_CELLS):
+            code = cells[cellno]
+            if code == NO_CARD:
+                continue
+            if packed[FOUNDATIONS_OFFSET + CARD_SUITE[code]] == CARD_VALUE[code] - 1:
+                child = bytearray(packed)
+                child[CELLS_OFFSET + cellno] = NO_CARD
+                child[FOUNDATIONS_OFFSET + CARD_SUITE[code]] += 1
+                children.append((MoveEvent(source="T%d" % cellno, dest="F%s" % SUITES[CARD_SUITE[code]], num=1), child))
+            for colno in range(NUM_COLUMNS):
+                top = tops[colno]
+                if (top == NO_CARD and colno == empty_column) or (top != NO_CARD and CAN_STACK[top * NUM_CARDS + code]):
+                    child = bytearray(packed)
+                    child[CELLS_OFFSET + cellno] = NO_CARD
+                    child[COLUMNS_OFFSET + colno * COLUMN_SIZE + heights[colno]] = code
+                    child[HEIGHTS_OFFSET + colno] += 1
+                    children.append((MoveEvent(source="T%d" % cellno, dest="C%d" % colno, num=1), child))
+
+        for colno in range(NUM_COLUMNS):
+            height = heights[colno]
+            if height == 0:
+                continue
+            start = COLUMNS_OFFSET + colno * COLUMN_SIZE
+            code = tops[colno]
+
+            # Column to foundation
+            if packed[FOUNDATIONS_OFFSET + CARD_SUITE[code]] == CARD_VALUE[code] - 1:
+                child = bytearray(packed)
+                child[start + height - 1] = 0
+                child[HEIGHTS_OFFSET + colno] -= 1
+                child[FOUNDATIONS_OFFSET + CARD_SUITE[code]] += 1
+                children.append((MoveEvent(source="C%d" % colno, dest="F%s" % SUITES[CARD_SUITE[code]], num=1), child))
+
+            # Length of the sequence at the top of the column
+            run = 1
+            while run < height and CAN_STACK[packed[start + height - run - 1] * NUM_CARDS + packed[start + height - run]]:
+                run += 1
+
+            # Column to column, as a sequence move
+            for dest in range(NUM_COLUMNS):
+                if dest == colno:
+                    continue
+                top = tops[dest]
+                if top == NO_CARD:
+                    # Only the first empty column, and never the whole column
+                    if dest != empty_column or run == height:
+                        continue
+                    num = min(run, max_sequence(free_cells, empty_columns - 1))
+                else:
+                    num = CARD_VALUE[top] - CARD_VALUE[code]
+                    if num < 1 or num > run or not CAN_STACK[top * NUM_CARDS + packed[start + height - num]]:
+                        continue
+                    if num > max_sequence(free_cells, empty_columns):
+                        continue
+                child = bytearray(packed)
+                dest_start = COLUMNS_OFFSET + dest * COLUMN_SIZE + heights[dest]
+                child[dest_start:dest_start + num] = packed[start + height - num:start + height]
+                child[start + height - num:start + height] = bytearray(num)
+                child[HEIGHTS_OFFSET + colno] -= num
+                child[HEIGHTS_OFFSET + dest] += num
+                children.append((MoveEvent(source="C%d" % colno, dest="C%d" % dest, num=num), child))
+
+            # Column to free cell
+            if free_cell >= 0:
+                child = bytearray(packed)
+                child[start + height - 1] = 0
+                child[HEIGHTS_OFFSET + colno] -= 1
+                child[CELLS_OFFSET + free_cell] = code
+                children.append((MoveEvent(source="C%d" % colno, dest="T%d" % free_cell, num=1), child))
+
+        return children
+
+def solve(table, **kwargs):
+    """
+    :param Tableau table: Table to solve
+    :rtype: list[MoveEvent] | None
+    """
+    return Solver(**kwargs).solve(table)
+
+def solve_seed(seed, **kwargs):
+    """
+    :param int seed: Deal seed
+    :rtype: list[MoveEvent] | None
+    """
+    return Solver(**kwargs).solve_seed(seed)
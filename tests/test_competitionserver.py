@@ -0,0 +1,120 @@
+import unittest
+
+from freecell.server import events
+from freecell.server.competitionserver import CompetitionServer
+from freecell.shared.protocol import JSON
+from freecell.shared.version import VERSION
+
+class FakeConnection(object):
+    def __init__(self, connection_id):
+        self.id = connection_id
+        self.state = "connected"
+        self.framing = JSON
+        self.timeout = None
+        self.in_game = False
+        self.sent = []
+
+    def expect(self, timeout, reason="Timed out"):
+        self.timeout = timeout
+
+    def send_message(self, name, **values):
+        self.sent.append(name)
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = CompetitionServer("localhost", 0, verify_processes=1)
+        self.connection = FakeConnection("ABCDEFGH")
+        self.join()
+
+    def tearDown(self):
+        # Drops the login's handlers from the shared dispatch
+        self.quit()
+        self.server.verify_pool.terminate()
+        self.server.networking.waker.close()
+        self.server.networking.close()
+
+    def join(self):
+        self.server.competitor_join(events.make_event('JoinEvent', id=self.connection.id, version=VERSION,
+                                                      framing=[], object=self.connection))
+
+    def auth(self):
+        self.server.competitor_auth(events.make_event('AuthEvent', id=self.connection.id, connection=self.connection))
+
+    def quit(self):
+        self.server.competitor_quit(events.make_event('QuitEvent', id=self.connection.id, reason="Client disconnected"))
+
+class LoginOrderTest(ServerTest):
+    def test_auth(self):
+        self.auth()
+        self.assertIn(self.connection.id, self.server.competitors)
+        self.assertNotIn(self.connection.id, self.server.logins)
+        self.assertEqual(self.server.logins_done.value, 1)
+        self.assertIsNone(self.connection.timeout)
+        self.assertEqual(self.connection.sent, ["joinedroom"])
+
+    def test_quit_before_auth(self):
+        self.connection.state = "disconnected"
+        self.quit()
+        self.auth()
+        self.assertEqual(self.server.competitors, {})
+        self.assertEqual(self.server.logins, {})
+        self.assertEqual(self.server.logins_done.value, 0)
+        self.assertNotIn("joinedroom", self.connection.sent)
+
+    def test_auth_after_disconnect(self):
+        # The QuitEvent is still queued behind the AuthEvent
+        self.connection.state = "disconnected"
+        self.auth()
+        self.assertEqual([key for key in self.server.event_dispatch.scoped if key[1] == self.connection.id], [])
+        self.quit()
+        self.assertEqual(self.server.competitors, {})
+        self.assertEqual(self.server.logins, {})
+        self.assertEqual(self.server.logins_done.value, 0)
+        self.assertEqual(self.server.connection_states()["playing"], 0)
+
+    def test_connect_again_while_logging_in(self):
+        self.connection.timeout = None
+        self.join()
+        self.assertIsNone(self.connection.timeout)
+
+    def test_connect_again_after_auth(self):
+        self.auth()
+        self.join()
+        self.assertIsNone(self.connection.timeout)
+        self.assertNotIn(self.connection.id, self.server.logins)
+        self.assertEqual(self.connection.sent, ["joinedroom"])
+
+    def test_seed_starts_game(self):
+        self.auth()
+        self.server.send_seed(events.make_event('SeedRequestEvent', id=self.connection.id))
+        self.assertTrue(self.connection.in_game)
+
+    def test_connect_again_keeps_one_login(self):
+        for attempt in range(4):
+            self.join()
+        scoped = self.server.event_dispatch.scoped
+        self.assertEqual(len(scoped[("LoginEvent", self.connection.id)]), 1)
+        self.quit()
+        self.assertEqual([key for key in scoped if key[1] == self.connection.id], [])
+
+class RoomTest(ServerTest):
+    def join_room(self, room):
+        self.server.competitor_join_room(events.make_event('JoinRoomEvent', id=self.connection.id, room=room))
+
+    def test_room_name(self):
+        self.auth()
+        self.join_room(u"caf\xe9")
+        self.assertEqual(self.server.competitors[self.connection.id].room.id, CompetitionServer.DEFAULT_ROOM)
+
+    def test_join_own_room(self):
+        self.auth()
+        self.join_room("blue")
+        room = self.server.rooms["blue"]
+        room.rounds = 1
+        self.join_room("blue")
+        self.assertIs(self.server.rooms["blue"], room)
+        self.assertEqual(room.rounds, 1)
+        self.assertEqual(self.connection.sent, ["joinedroom"] * 3)
+
+if __name__ == "__main__":
+    unittest.main()
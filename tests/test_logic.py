@@ -0,0 +1,36 @@
+import unittest
+
+from freecell.client import events
+from freecell.client.board import autoplay
+from freecell.client.logic import FreeCellLogic
+
+class GuiMoveTest(unittest.TestCase):
+    # Seed 10, ending with a two card sequence move that uncovers a safe card
+    SEED = 10
+    MOVES = [("C4", "T2"), ("C3", "T1"), ("C4", "T0"), ("C0", "T3"), ("C5", "C1"), ("C3", "C7"),
+             ("T2", "C6"), ("C0", "T2"), ("C6", "C5"), ("T1", "C6"), ("C1", "C4")]
+
+    def setUp(self):
+        self.event_dispatch = events.event_dispatch
+        self.logic = FreeCellLogic(headless=True)
+        self.logic.start()
+        self.logic.load_seed(self.SEED)
+
+    def tearDown(self):
+        self.event_dispatch.unregister(self.logic.process_move, ["MoveEvent"])
+        self.event_dispatch.unregister(self.logic.process_compound_move, ["CompoundMoveEvent"])
+        self.event_dispatch.unregister(self.logic.automove, ["MoveCompleteEvent"])
+
+    def gui_move(self, source, dest):
+        # As the GUI sends it: one card selected, then MoveCompleteEvent
+        self.event_dispatch.send(events.MoveEvent(source=source, dest=dest, num=1))
+        self.event_dispatch.send(events.MoveCompleteEvent(unused=""))
+        self.event_dispatch.update(1.0)
+
+    def test_automove_after_supermove(self):
+        for source, dest in self.MOVES:
+            self.gui_move(source, dest)
+        self.assertEqual(autoplay(bytearray(self.logic.table.packed)), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+import socket
+import unittest
+
+from freecell.server.network import FreecellConnection
+from freecell.server.timerwheel import TimerWheel
+
+class IdleTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.connection = FreecellConnection(self.sock, ("localhost", 0), TimerWheel())
+
+    def tearDown(self):
+        self.connection.close()
+        self.peer.close()
+
+    def test_idle(self):
+        self.connection.check_idle()
+        self.assertEqual(self.connection.state, "disconnected")
+
+    def test_idle_in_game(self):
+        # Clients send nothing while a game is played
+        self.connection.in_game = True
+        self.connection.check_idle()
+        self.assertNotEqual(self.connection.state, "disconnected")
+
+if __name__ == "__main__":
+    unittest.main()